@@ -31,39 +31,1781 @@
 # $Id: runAGFR.py,v 1.28.2.8 2017/10/05 20:30:46 annao Exp $
 #
 import numpy, tempfile, os, sys, shutil, platform, datetime, pickle
-from time import time
+import hashlib, json, struct, zlib, zipfile, atexit
+from time import time, sleep
 from glob import glob
 from math import ceil
+from contextlib import contextmanager
 
-from MolKit2 import Read
-from prody.atomic.atom import Atom
-from ADFR import checkLigandFile
-from ADFR.utils.maps import flexResStr2flexRes
-from ADFR.utils.MakeGrids import splitFlexRes
-from ADFR.utils.addGradients import addGradientToMaps
+# MolKit2, prody, ADFR and AutoSite are imported where they are used so that
+# importing this module (e.g. for validateBox) does not load them
 
-from AutoSite.compositePoints import CompositePoints
-from AutoSite.utils.clusterTPoints import DensityClustering
-from AutoSite.scoreClusters import scoreClusters
-from AutoSite.shrink import shrinkPocket
+class ATOMRecordIndex:
+    """
+    index of the ATOM and HETATM records of a PDB/PDBQT file built with a
+    single streaming scan. Records are numbered in file order and stored as
+    byte offset and length, along with their serial numbers.
+    """
 
-def saveATOMS(mol, filename, selection):
+    def __init__(self, filename):
+        self.filename = filename
+        offsets = []
+        lengths = []
+        serials = []
+        offset = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                if line.startswith(b'ATOM') or line.startswith(b'HETATM'):
+                    offsets.append(offset)
+                    lengths.append(len(line))
+                    try:
+                        serials.append(int(line[6:11]))
+                    except ValueError: # hybrid-36 or missing serial number
+                        serials.append(-1)
+                offset += len(line)
+        self.offsets = numpy.array(offsets, 'int64')
+        self.lengths = numpy.array(lengths, 'int64')
+        self.serials = numpy.array(serials, 'int64')
+        self._serialToRecord = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def recordNumbers(self, mol, selection):
+        # return the record numbers of the atoms in selection.
+        # When the file has one record per atom of mol, records are in atom
+        # order and the atom index is used, otherwise the serial number
+        indices = selection.getIndices()
+        if len(self) == mol._ag.numAtoms():
+            return numpy.array(indices, 'int64')
+        if self._serialToRecord is None:
+            d = {}
+            for n, serial in enumerate(self.serials):
+                d.setdefault(serial, n)
+            self._serialToRecord = d
+        return numpy.array([self._serialToRecord[s] for s in
+                            mol._ag.getSerials()[indices]], 'int64')
+
+    def write(self, filename, records):
+        # copy the specified records, in file order, to filename
+        with open(self.filename, 'rb') as src:
+            with open(filename, 'wb') as dst:
+                for n in numpy.unique(records):
+                    src.seek(self.offsets[n])
+                    dst.write(src.read(self.lengths[n]))
+
+def saveATOMS(mol, filename, selection, index=None):
     # save the ATOM or HETATM records for the specified selection 
     # from the original file of mol
-    toSave = {}
-    for a in selection:
-        toSave['%.3f,%.3f,%.3f'%(tuple(a.getCoords()))] = True
-    f = open(mol.filename)
-    lines = f.readlines()
-    f.close()
-
-    f = open(filename, 'w')
-    for line in lines:
-        if line.startswith('ATOM') or line.startswith('HETATM'):
-            key = '%.3f,%.3f,%.3f'%(float(line[30:38]),float(line[38:46]),float(line[46:54]))
-            if toSave.has_key(key):
+    if index is None:
+        index = ATOMRecordIndex(mol.filename)
+    index.write(filename, index.recordNumbers(mol, selection))
+
+##
+## binary receptor cache
+##
+# A parsed receptor is saved with prody's saveAtoms next to the receptor
+# file as <receptor>.agfr.ag.npz (coordinates, names, residues, AD types,
+# charges, bonds ...) with a <receptor>.agfr.json file recording the
+# size, mtime and sha1 of the receptor it was built from. The cache is
+# used when the size and mtime match or, after a touch, when the sha1
+# still matches.
+
+def _sha1File(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def receptorCacheFiles(filename):
+    # return the (atoms, info) file names of the cache of a receptor file
+    base = filename+'.agfr'
+    return base+'.ag.npz', base+'.json'
+
+def loadCachedReceptor(filename):
+    # return a MolKit2 Molecule rebuilt from the binary cache of filename,
+    # or None when there is no valid cache or the molecule can not be
+    # rebuilt (the receptor is then parsed from the text file)
+    agFile, infoFile = receptorCacheFiles(filename)
+    if not os.path.exists(agFile) or not os.path.exists(infoFile):
+        return None
+    try:
+        with open(infoFile) as f:
+            info = json.load(f)
+        st = os.stat(filename)
+        if info['size'] != st.st_size:
+            return None
+        if info['mtime'] != st.st_mtime:
+            if info['sha1'] != _sha1File(filename):
+                return None
+            info['mtime'] = st.st_mtime
+            with open(infoFile, 'w') as f:
+                json.dump(info, f)
+        from prody import loadAtoms
+        from MolKit2.molecule import Molecule
+        ag = loadAtoms(agFile)
+        mol = Molecule(info['name'], ag, filename=filename)
+        mol.filename = filename
+        if mol._ag.numAtoms() != info['numAtoms']:
+            return None
+    except Exception:
+        return None
+    return mol
+
+def saveCachedReceptor(mol, filename):
+    # write the binary cache of the receptor mol read from filename.
+    # Returns False when the cache can not be written (e.g. read only folder)
+    agFile, infoFile = receptorCacheFiles(filename)
+    st = os.stat(filename)
+    info = {'size': st.st_size, 'mtime': st.st_mtime,
+            'sha1': _sha1File(filename), 'name': mol.name,
+            'numAtoms': mol._ag.numAtoms()}
+    tmp = '%s.tmp%d'%(filename, os.getpid())
+    try:
+        from prody import saveAtoms
+        saveAtoms(mol._ag, tmp+'.ag.npz')
+        os.rename(tmp+'.ag.npz', agFile)
+        with open(tmp+'.json', 'w') as f:
+            json.dump(info, f)
+        os.rename(tmp+'.json', infoFile)
+    except (IOError, OSError):
+        for name in (tmp+'.ag.npz', tmp+'.json'):
+            if os.path.exists(name):
+                os.remove(name)
+        return False
+    return True
+
+# number of grid points above which the W map is computed in slabs
+WMAP_CHUNK_POINTS = 1<<22
+
+def combineWmap(OAdata, HDdata, weight, ENTROPY, out=None):
+    # W map rule: ENTROPY where either map is positive, else weight times
+    # the most favorable of the two values.
+    # The product is computed in double precision and rounded once to
+    # float32, which gives the same values as the per-point loop
+    # (numpy scalar * python float is done in double precision)
+    oa = numpy.asarray(OAdata)
+    hd = numpy.asarray(HDdata)
+    if out is None:
+        out = numpy.zeros(oa.shape, 'f')
+    numpy.multiply(numpy.minimum(oa, hd), weight, out=out, dtype='d',
+                   casting='same_kind')
+    out[(oa > 0) | (hd > 0)] = ENTROPY
+    return out
+
+def _wMapLoop(OAdata, HDdata, weight, ENTROPY):
+    # reference per-point implementation of the W map rule used to validate
+    # and benchmark combineWmap
+    nx,ny,nz = OAdata.shape
+    wData = numpy.zeros(OAdata.shape, 'f')
+    for i in range(nx):
+        for j in range(ny):
+            for k in range(nz):
+                oa = OAdata[i][j][k]
+                hd = HDdata[i][j][k]
+                if oa > 0 or hd > 0:
+                    wData[i][j][k] = ENTROPY
+                else:
+                    if oa < hd:
+                        wData[i][j][k] = OAdata[i][j][k] * weight
+                    else:
+                        wData[i][j][k] = HDdata[i][j][k] * weight
+    return wData
+
+def benchmarkWmap(sizes=(16, 32, 64, 96), weight=0.6, ENTROPY=-0.2, seed=1):
+    # time the per-point loop against the array engine on random OA/HD
+    # grids of size n*n*n and check that both give identical maps
+    rand = numpy.random.RandomState(seed)
+    agfr = runAGFR()
+    results = []
+    print('%8s %10s %10s %10s %10s %s'%('size', 'points', 'loop(s)',
+                                        'array(s)', 'speedup', 'identical'))
+    for n in sizes:
+        OAdata = rand.uniform(-2., 0.5, (n, n, n)).astype('f')
+        HDdata = rand.uniform(-2., 0.5, (n, n, n)).astype('f')
+        t0 = time()
+        ref = _wMapLoop(OAdata, HDdata, weight, ENTROPY)
+        tloop = time()-t0
+        t0 = time()
+        wData = agfr.best(OAdata, HDdata, weight, ENTROPY)
+        tarr = time()-t0
+        same = ref.tobytes() == wData.tobytes()
+        print('%8d %10d %10.3f %10.4f %10.1f %s'%(
+            n, n**3, tloop, tarr, tloop/max(tarr, 1e-6), same))
+        results.append((n, tloop, tarr, same))
+    return results
+
+##
+## fill point clustering
+##
+class FillPointClustering:
+    """
+    density clustering of AutoSite fill points using a spatial index, as an
+    alternative to AutoSite's DensityClustering. Points are grid indices;
+    two points are neighbors when they are within radius grid units
+    (default sqrt(3), i.e. the 26 surrounding grid points). Points with at
+    least neighborPts neighbors are core points, clusters are the connected
+    core points plus the non core points attached to them. Clusters with
+    fewer than cVolcut points are dropped.
+    After findClustersD, _clusters holds the lists of point indices of the
+    clusters (largest first) and _clen their lengths, like DensityClustering.
+    method is 'kdtree' (scipy cKDTree, falls back to 'celllist' when scipy
+    is missing) or 'celllist' (numpy only).
+    """
+
+    def __init__(self, spacing, neighborPts=14, radius=1.75, method='kdtree'):
+        self.spacing = spacing
+        self.neighborPts = neighborPts
+        self.radius = radius
+        self.method = method
+        self._clusters = []
+        self._clen = []
+
+    def neighborPairs(self, pts):
+        # return arrays (i, j), i<j, of the pairs of points within radius
+        if self.method == 'kdtree':
+            try:
+                from scipy.spatial import cKDTree
+            except ImportError:
+                pass
+            else:
+                pairs = cKDTree(pts).query_pairs(self.radius, output_type='ndarray')
+                return pairs[:,0], pairs[:,1]
+        return self._cellListPairs(pts)
+
+    def _cellListPairs(self, pts):
+        # hash points into cells of size radius and compare each point with
+        # the points of the 27 surrounding cells
+        r = self.radius
+        cells = numpy.floor((pts-pts.min(0))/r).astype('int64')+1
+        dims = cells.max(0)+2 # empty border so that neighbor keys never wrap
+        def cellKey(c):
+            return (c[:,0]*dims[1]+c[:,1])*dims[2]+c[:,2]
+        keys = cellKey(cells)
+        order = numpy.argsort(keys, kind='mergesort')
+        skeys = keys[order]
+        n = len(pts)
+        I = []
+        J = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    nkeys = cellKey(cells+numpy.array([dx, dy, dz]))
+                    lo = numpy.searchsorted(skeys, nkeys, 'left')
+                    counts = numpy.searchsorted(skeys, nkeys, 'right')-lo
+                    total = counts.sum()
+                    if total == 0:
+                        continue
+                    i = numpy.repeat(numpy.arange(n), counts)
+                    starts = numpy.repeat(numpy.cumsum(counts)-counts, counts)
+                    j = order[numpy.repeat(lo, counts)+numpy.arange(total)-starts]
+                    keep = i < j
+                    i = i[keep]
+                    j = j[keep]
+                    d2 = numpy.sum((pts[i]-pts[j])**2, 1)
+                    keep = d2 <= r*r
+                    I.append(i[keep])
+                    J.append(j[keep])
+        if not len(I):
+            return numpy.zeros(0, 'int64'), numpy.zeros(0, 'int64')
+        return numpy.concatenate(I), numpy.concatenate(J)
+
+    def findClustersD(self, indices, cVolcut=10):
+        pts = numpy.asarray(indices, 'd').reshape(-1, 3)
+        n = len(pts)
+        self._clusters = []
+        self._clen = []
+        if n == 0:
+            return self._clusters
+        i, j = self.neighborPairs(pts)
+        counts = numpy.bincount(i, minlength=n)+numpy.bincount(j, minlength=n)
+        core = counts >= self.neighborPts
+        # connected components of the core points by label propagation
+        labels = numpy.arange(n)
+        cc = core[i] & core[j]
+        ci, cj = i[cc], j[cc]
+        while len(ci):
+            low = numpy.minimum(labels[ci], labels[cj])
+            newLabels = labels.copy()
+            numpy.minimum.at(newLabels, ci, low)
+            numpy.minimum.at(newLabels, cj, low)
+            newLabels = newLabels[newLabels] # pointer jumping
+            if numpy.array_equal(newLabels, labels):
+                break
+            labels = newLabels
+        # attach non core points to a neighboring core point's cluster
+        member = core.copy()
+        for a, b in ((i, j), (j, i)):
+            border = core[a] & ~core[b]
+            labels[b[border]] = labels[a[border]]
+            member[b[border]] = True
+        ids = numpy.nonzero(member)[0]
+        order = numpy.argsort(labels[ids], kind='mergesort')
+        ids = ids[order]
+        bounds = numpy.nonzero(numpy.diff(labels[ids]))[0]+1
+        clusters = [c.tolist() for c in numpy.split(ids, bounds)
+                    if len(c) >= cVolcut]
+        clusters.sort(key=len, reverse=True)
+        self._clusters = clusters
+        self._clen = [len(c) for c in clusters]
+        return clusters
+
+def _syntheticFillPoints(nbPockets=20, seed=1):
+    # grid indices of random blobs of fill points for benchmarking
+    rand = numpy.random.RandomState(seed)
+    pts = set()
+    for n in range(nbPockets):
+        center = rand.randint(10, 150, 3)
+        radius = rand.uniform(2, 7)
+        r = int(ceil(radius))
+        g = numpy.mgrid[-r:r+1, -r:r+1, -r:r+1].reshape(3, -1).T
+        g = g[numpy.sum(g**2, 1) <= radius**2]
+        for p in g+center:
+            pts.add(tuple(p))
+    # sprinkle isolated points
+    for p in rand.randint(0, 160, (len(pts)//10, 3)):
+        pts.add(tuple(p))
+    return numpy.array(sorted(pts))
+
+def benchmarkClustering(indices=None, spacing=1.0, cutoff=10, neighborPts=14,
+                        top=10):
+    # compare the run time of AutoSite's DensityClustering with the spatial
+    # index engines on the same fill points (grid indices, synthetic blobs
+    # when None) and the agreement of their pockets: for each of the top
+    # reference pockets the best Jaccard index with a pocket of the engine
+    if indices is None:
+        indices = _syntheticFillPoints()
+    indices = numpy.asarray(indices)
+    engines = [('celllist', FillPointClustering(spacing, neighborPts, method='celllist')),
+               ('kdtree', FillPointClustering(spacing, neighborPts, method='kdtree'))]
+    try:
+        from AutoSite.utils.clusterTPoints import DensityClustering
+        engines.insert(0, ('autosite', DensityClustering(
+            [spacing, spacing, spacing], neighborPts=neighborPts)))
+    except ImportError:
+        print('AutoSite not available, using celllist as reference')
+    results = []
+    for name, engine in engines:
+        t0 = time()
+        engine.findClustersD(indices, cVolcut=cutoff)
+        results.append((name, time()-t0,
+                        [set(c) for c in engine._clusters]))
+    ref = results[0][2][:top]
+    print('%d fill points, reference %s'%(len(indices), results[0][0]))
+    print('%10s %10s %9s %s'%('engine', 'time(s)', 'pockets', 'top pocket agreement'))
+    for name, dt, clusters in results:
+        agreement = []
+        for rc in ref:
+            agreement.append(max([len(rc & c)/float(len(rc | c))
+                                  for c in clusters] or [0.]))
+        print('%10s %10.4f %9d %s'%(name, dt, len(clusters), ' '.join(
+            ['%.2f'%a for a in agreement])))
+    return results
+
+##
+## asynchronous jobs
+##
+class AGFRJobCancelled(Exception):
+    pass
+
+class AGFRFuture:
+    """
+    handle on a job submitted to an AGFRJobScheduler. result() waits for
+    the job and returns its value or raises its exception. then() chains a
+    job that is submitted with this job's result once it is available.
+    Only jobs that have not started can be cancelled.
+    """
+
+    def __init__(self, scheduler, fn, args, kw):
+        import threading
+        self._scheduler = scheduler
+        self._fn = fn
+        self._args = args
+        self._kw = kw
+        self._state = 'pending' # running, finished, cancelled
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def cancel(self):
+        with self._lock:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+            self._exception = AGFRJobCancelled()
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def running(self):
+        return self._state == 'running'
+
+    def done(self):
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        if not self._done.wait(timeout) and not self._done.is_set():
+            raise RuntimeError('job not finished after %s seconds'%timeout)
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        # the exception raised by the job or None. Like result, raises when
+        # the job is not finished after timeout or was cancelled
+        self._wait(timeout)
+        if isinstance(self._exception, AGFRJobCancelled):
+            raise self._exception
+        return self._exception
+
+    def add_done_callback(self, fn):
+        # fn(future) is called once the job has finished or was cancelled
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def then(self, fn, *args, **kw):
+        # return the future of fn(result, *args, **kw) which is submitted
+        # when this job succeeds. It fails or is cancelled with this job
+        future = AGFRFuture(self._scheduler, fn, args, kw)
+        def chain(parent):
+            if parent._exception is not None:
+                if isinstance(parent._exception, AGFRJobCancelled):
+                    future.cancel()
+                else:
+                    with future._lock:
+                        future._state = 'finished'
+                        future._exception = parent._exception
+                    future._finish()
+            else:
+                future._args = (parent._result,)+args
+                self._scheduler._enqueue(future)
+        self.add_done_callback(chain)
+        return future
+
+    def _run(self):
+        with self._lock:
+            if self._state != 'pending':
+                return
+            self._state = 'running'
+        try:
+            self._result = self._fn(*self._args, **self._kw)
+        except Exception as e:
+            self._exception = e
+        self._state = 'finished'
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+class AGFRJobScheduler:
+    """
+    runs jobs in at most maxWorkers threads. AGFR jobs spend their time
+    waiting on AutoGrid processes, so threads are enough to overlap them,
+    e.g. the AutoSite run of receptor B with the map computation of
+    receptor A:
+        sched = AGFRJobScheduler(2)
+        fa = agfrA.runAutoSiteAsync(sched).then(prepareA)
+        fb = agfrB.runAutoSiteAsync(sched).then(prepareB)
+        fa.result(); fb.result()
+    """
+
+    def __init__(self, maxWorkers=2):
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+        self.maxWorkers = maxWorkers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._pending = []
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kw):
+        future = AGFRFuture(self, fn, args, kw)
+        self._enqueue(future)
+        return future
+
+    def _enqueue(self, future):
+        import threading
+        if self._shutdown:
+            future.cancel()
+            return
+        self._pending.append(future)
+        self._queue.put(future)
+        if len(self._threads) < self.maxWorkers:
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            future = self._queue.get()
+            if future is None:
+                return
+            future._run()
+            if future in self._pending:
+                self._pending.remove(future)
+
+    def shutdown(self, wait=True, cancelPending=False):
+        # stop accepting jobs, optionally cancel the jobs not yet started
+        self._shutdown = True
+        if cancelPending:
+            for future in list(self._pending):
+                future.cancel()
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+##
+## AutoGrid map files
+##
+# an AutoGrid map file has 6 header lines (GRID_PARAMETER_FILE,
+# GRID_DATA_FILE, MACROMOLECULE, SPACING, NELEMENTS, CENTER) followed by one
+# value per line for the (nx+1)*(ny+1)*(nz+1) grid points, x varying fastest.
+# Map data is handled as float32 arrays of shape (nz+1, ny+1, nx+1)
+
+MAP_HEADER_LINES = 6
+# estimates used by the dry-run planner: average bytes per value of a text
+# map ("-0.123\n"), size of a map header and fraction of the text maps
+# remaining after deflate in .trg archives
+MAP_TEXT_POINT_BYTES = 7
+MAP_HEADER_BYTES = 200
+MAP_TEXT_DEFLATE_RATIO = 0.3
+
+def calibrateMapTime(profileFiles):
+    # return (seconds per grid point and map, number of samples) for the
+    # map computations recorded in profile files saved with the profile
+    # option, or (None, 0) when there is none
+    wall = work = 0.
+    n = 0
+    for name in profileFiles:
+        try:
+            with open(name) as f:
+                profile = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for record in profile.get('phases', []):
+            if record.get('phase') == 'map computation' and \
+                   record.get('gridPoints') and record.get('nbMaps'):
+                wall += record['wall']
+                work += record['gridPoints']*record['nbMaps']
+                n += 1
+    if work == 0:
+        return None, 0
+    return wall/work, n
+
+def parseMapHeader(lines):
+    # return a dict with the header lines, spacing, nelements and center
+    header = {'lines': [l.rstrip('\r\n') for l in lines[:MAP_HEADER_LINES]]}
+    for line in header['lines']:
+        w = line.split()
+        if not len(w):
+            continue
+        if w[0] == 'SPACING':
+            header['spacing'] = float(w[1])
+        elif w[0] == 'NELEMENTS':
+            header['nelements'] = [int(x) for x in w[1:4]]
+        elif w[0] == 'CENTER':
+            header['center'] = [float(x) for x in w[1:4]]
+    return header
+
+def readMapHeader(filename):
+    with open(filename) as f:
+        lines = [f.readline() for i in range(MAP_HEADER_LINES)]
+    return parseMapHeader(lines)
+
+def mapShape(header):
+    nx, ny, nz = header['nelements']
+    return (nz+1, ny+1, nx+1)
+
+def mapHeader(header, nelements, center):
+    # return a copy of header describing a grid of the same spacing with
+    # the specified nelements and center
+    lines = []
+    for line in header['lines']:
+        if line.startswith('NELEMENTS'):
+            line = 'NELEMENTS %d %d %d'%tuple(nelements)
+        elif line.startswith('CENTER'):
+            line = 'CENTER %.3f %.3f %.3f'%tuple(center)
+        lines.append(line)
+    newHeader = dict(header)
+    newHeader.update({'lines': lines, 'nelements': list(nelements),
+                      'center': list(center)})
+    return newHeader
+
+def loadMapFile(filename):
+    # return (header, data) for an AutoGrid map file
+    with open(filename) as f:
+        lines = [f.readline() for i in range(MAP_HEADER_LINES)]
+        data = numpy.fromstring(f.read(), dtype='f', sep=' ')
+    header = parseMapHeader(lines)
+    return header, data.reshape(mapShape(header))
+
+def readMapStream(f, blockSize=1<<22):
+    # return (header, data) for an AutoGrid map read from the binary file
+    # object f (e.g. a zip archive member) by blocks of blockSize bytes
+    header = parseMapHeader([f.readline().decode('ascii')
+                             for i in range(MAP_HEADER_LINES)])
+    shape = mapShape(header)
+    data = numpy.zeros(int(numpy.prod(shape)), 'f')
+    n = 0
+    rest = b''
+    while True:
+        block = f.read(blockSize)
+        if not block:
+            break
+        block = rest+block
+        end = block.rfind(b'\n')+1
+        if end == 0:
+            rest = block
+            continue
+        values = numpy.fromstring(block[:end].decode('ascii'), dtype='f', sep=' ')
+        data[n:n+len(values)] = values
+        n += len(values)
+        rest = block[end:]
+    if rest.strip():
+        values = numpy.fromstring(rest.decode('ascii'), dtype='f', sep=' ')
+        data[n:n+len(values)] = values
+        n += len(values)
+    if n != len(data):
+        raise ValueError('map has %d values, expected %d'%(n, len(data)))
+    return header, data.reshape(shape)
+
+def writeMapFile(filename, header, data, fmt='%.3f'):
+    # write data (shape (nz+1, ny+1, nx+1)) as an AutoGrid map file
+    with open(filename, 'w') as f:
+        f.write('\n'.join(header['lines'])+'\n')
+        numpy.savetxt(f, numpy.ravel(data), fmt=fmt)
+
+def streamWmap(OAfile, HDfile, outFile, weight, ENTROPY, fmt='%.3f'):
+    # write the W map combining two AutoGrid map files one z plane at a
+    # time, so that only a plane of each map is held in memory. The header
+    # is copied from the HD map
+    from itertools import islice
+    with open(OAfile) as oaf, open(HDfile) as hdf, open(outFile, 'w') as out:
+        oaHeader = parseMapHeader([oaf.readline() for i in range(MAP_HEADER_LINES)])
+        hdHeader = parseMapHeader([hdf.readline() for i in range(MAP_HEADER_LINES)])
+        if oaHeader.get('nelements') != hdHeader.get('nelements'):
+            raise ValueError('W map: %s and %s have different grid sizes'%(
+                OAfile, HDfile))
+        nz, ny, nx = mapShape(hdHeader)
+        planeSize = ny*nx
+        plane = numpy.zeros(planeSize, 'f')
+        out.write('\n'.join(hdHeader['lines'])+'\n')
+        for k in range(nz):
+            oa = numpy.array(list(islice(oaf, planeSize)), 'f')
+            hd = numpy.array(list(islice(hdf, planeSize)), 'f')
+            if len(oa) != planeSize or len(hd) != planeSize:
+                raise ValueError('W map: unexpected end of map file')
+            combineWmap(oa, hd, weight, ENTROPY, out=plane)
+            numpy.savetxt(out, plane, fmt=fmt)
+
+def rewriteGridDescriptors(folder, nelements, center, spacing):
+    # update the AVS field (.fld) and extent (.xyz) files of a grid folder
+    # for a grid with the specified nelements, center and spacing
+    for name in glob(os.path.join(folder, '*.fld')):
+        with open(name) as f:
+            lines = f.readlines()
+        with open(name, 'w') as f:
+            for line in lines:
+                if line.startswith('#NELEMENTS'):
+                    line = '#NELEMENTS %d %d %d\n'%tuple(nelements)
+                elif line.startswith('#CENTER'):
+                    line = '#CENTER %.3f %.3f %.3f\n'%tuple(center)
+                else:
+                    for i in range(3):
+                        if line.startswith('dim%d='%(i+1)):
+                            line = 'dim%d=%d\n'%(i+1, nelements[i]+1)
                 f.write(line)
-    f.close()
+    for name in glob(os.path.join(folder, '*.xyz')):
+        with open(name, 'w') as f:
+            for c, n in zip(center, nelements):
+                f.write('%.3f %.3f\n'%(c-n*spacing/2., c+n*spacing/2.))
+
+def _fldComponents(lines):
+    # return (label, variable) line pairs of the maps of an AVS field file
+    labels = [l for l in lines if l.startswith('label=')]
+    variables = [l for l in lines if l.startswith('variable ')]
+    return list(zip(labels, variables))
+
+def mergeFieldFiles(fldFile, otherFldFiles, mapFiles=None):
+    # add the maps of the AVS field files otherFldFiles (computed over the
+    # same grid with atypesOnly) to fldFile. Their affinity maps are
+    # inserted after the affinity maps of fldFile, before its e and d maps.
+    # When mapFiles is given only the maps of these file names are added
+    with open(fldFile) as f:
+        lines = f.readlines()
+    components = _fldComponents(lines)
+    added = []
+    for name in otherFldFiles:
+        with open(name) as f:
+            added.extend(_fldComponents(f.readlines()))
+    known = set([v.split()[2] for l, v in components])
+    added = [c for c in added if c[1].split()[2] not in known]
+    if mapFiles is not None:
+        added = [c for c in added if c[1].split()[2][5:] in mapFiles]
+    n = len([c for c in components if c[0].find('-affinity') >= 0])
+    components = components[:n]+added+components[n:]
+    out = []
+    for line in lines:
+        if line.startswith('veclen='):
+            out.append('veclen=%d\n'%len(components))
+        elif line.startswith('label='):
+            if len(out) and out[-1].startswith('label='):
+                continue
+            for i, (label, variable) in enumerate(components):
+                out.append('%s\t# component label for variable %d\n'%(
+                    label.split('#')[0].strip(), i+1))
+        elif line.startswith('variable '):
+            if len(out) and out[-1].startswith('variable '):
+                continue
+            for i, (label, variable) in enumerate(components):
+                out.append('variable %d %s\n'%(i+1, ' '.join(variable.split()[2:])))
+        else:
+            out.append(line)
+    tmp = fldFile+'.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(out)
+    os.rename(tmp, fldFile)
+
+##
+## pocket results
+##
+class PocketResultsSink:
+    """
+    collects the pocket statistics and fill points of a run and writes them
+    in a single pass when flushed:
+      <base>_pockets.csv     one row of statistics per pocket
+      <base>_pocketNNN.csv   fill points of pocket NNN
+    and, when combinedFile is given, one row (receptor,pocket,x,y,z) per fill
+    point appended to combinedFile so that a batch of receptors can share
+    one table.
+    """
+
+    def __init__(self, filenameBase, combinedFile=None, receptor=''):
+        self.filenameBase = filenameBase
+        self.combinedFile = combinedFile
+        self.receptor = receptor
+        self.statsHeader = None
+        self.stats = []
+        self.points = []
+
+    def setStatsHeader(self, header):
+        self.statsHeader = header
+
+    def addStats(self, row):
+        self.stats.append(row)
+
+    def addPocketPoints(self, n, points):
+        self.points.append((n, numpy.asarray(points, 'd').reshape(-1, 3)))
+
+    def flush(self):
+        lines = self.stats
+        if self.statsHeader is not None:
+            lines = [self.statsHeader]+lines
+        with open(self.filenameBase+'_pockets.csv', 'w') as f:
+            f.write(''.join([l+'\n' for l in lines]))
+        for n, points in self.points:
+            numpy.savetxt(self.filenameBase+'_pocket%03d.csv'%n, points,
+                          fmt='%f', delimiter=',', header='x,y,z', comments='')
+        if self.combinedFile and len(self.points):
+            newFile = not os.path.exists(self.combinedFile)
+            with open(self.combinedFile, 'a') as f:
+                if newFile:
+                    f.write('receptor,pocket,x,y,z\n')
+                for n, points in self.points:
+                    prefix = '%s,%d,'%(self.receptor, n)
+                    f.write(''.join([prefix+'%f,%f,%f\n'%tuple(p)
+                                     for p in points]))
+        self.stats = []
+        self.points = []
+
+##
+## profiling
+##
+class PhaseProfiler:
+    """
+    records the wall time, CPU time of this process and of its children
+    (e.g. AutoGrid), the resident memory at the start and end and the peak
+    resident memory of named phases of a run. A disabled profiler records
+    nothing.
+    On Linux the peak is reset at the start of every phase through
+    /proc/self/clear_refs; elsewhere peakRSS is the peak of the process so
+    far and peakRSSScope is 'process' instead of 'phase'.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+        self.target = None # name of the target file being prepared
+        self.filename = None # where runAGFR saves the profile
+        self._open = [] # records of the phases in progress, outermost first
+
+    def _procStatus(self):
+        # current (VmRSS) and peak (VmHWM) resident set size in MB, read
+        # from /proc/self/status. (None, None) when unavailable
+        values = {}
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+                        values[line[:5]] = int(line.split()[1])/1024.
+        except (IOError, OSError, ValueError):
+            pass
+        return values.get('VmRSS'), values.get('VmHWM')
+
+    def _resetPeakRSS(self):
+        # reset VmHWM to the current RSS. Returns False when not supported
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except (IOError, OSError):
+            return False
+
+    def _peakRSS(self, who):
+        # peak resident set size in MB or None when unavailable
+        try:
+            import resource
+        except ImportError:
+            return None
+        rss = resource.getrusage(who).ru_maxrss
+        if sys.platform == 'darwin': # bytes on macOS, KB elsewhere
+            return rss/1024.**2
+        return rss/1024.
+
+    @contextmanager
+    def phase(self, name, **info):
+        # with profiler.phase('map computation', gridPoints=n): ...
+        if not self.enabled:
+            yield
+            return
+        record = {'phase': name}
+        record['rssStart'], hwm = self._procStatus()
+        # resetting the peak would hide it from the enclosing phases, so
+        # they keep the peak reached so far
+        for outer in self._open:
+            if hwm is not None and outer['peakRSS'] is not None:
+                outer['peakRSS'] = max(outer['peakRSS'], hwm)
+        reset = hwm is not None and self._resetPeakRSS()
+        record['peakRSS'] = record['rssStart'] if reset else None
+        self._open.append(record)
+        t0 = time()
+        c0 = os.times()
+        try:
+            yield
+        finally:
+            c1 = os.times()
+            self._open.remove(record)
+            record.update({'wall': time()-t0,
+                           'cpu': (c1[0]+c1[1])-(c0[0]+c0[1]),
+                           'childCpu': (c1[2]+c1[3])-(c0[2]+c0[3])})
+            record['rssEnd'], hwm = self._procStatus()
+            if reset and hwm is not None:
+                record['peakRSS'] = max(record['peakRSS'], hwm)
+                record['peakRSSScope'] = 'phase'
+            else:
+                record['peakRSS'] = None
+                record['peakRSSScope'] = 'process'
+            try:
+                import resource
+                if record['peakRSS'] is None:
+                    record['peakRSS'] = self._peakRSS(resource.RUSAGE_SELF)
+                record['peakChildRSS'] = self._peakRSS(resource.RUSAGE_CHILDREN)
+            except ImportError:
+                record['peakChildRSS'] = None
+            if self.target is not None:
+                record['target'] = self.target
+            record.update(info)
+            self.phases.append(record)
+
+    def asDict(self):
+        return {'node': platform.node(), 'platform': platform.platform(),
+                'pid': os.getpid(), 'phases': list(self.phases)}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.asDict(), f, indent=1)
+
+##
+## target (.trg) archives
+##
+_ZIP_LOCAL = struct.Struct('<IHHHHHIIIHH')
+_ZIP_CENTRAL = struct.Struct('<IHHHHHHIIIHHHHHII')
+_ZIP_END = struct.Struct('<IHHHHIIH')
+_ZIP_LIMIT = 0xFFFF0000 # above this size archives need zip64 extensions
+
+def _dosDateTime(t):
+    y, mo, d, h, mi, sec = datetime.datetime.fromtimestamp(t).timetuple()[:6]
+    y = max(y, 1980)
+    return ((y-1980)<<9 | mo<<5 | d), (h<<11 | mi<<5 | sec//2)
+
+def _compressMember(args):
+    # compute the CRC and the raw deflate stream of a file, reading it in
+    # blocks. With level 0 the file is stored and only the CRC is computed
+    path, level = args
+    crc = 0
+    size = 0
+    chunks = []
+    comp = None
+    if level:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            if comp:
+                chunks.append(comp.compress(block))
+    if comp:
+        chunks.append(comp.flush())
+    return crc & 0xFFFFFFFF, size, chunks
+
+def writeZipArchive(zipName, folder, level=6, jobs=None, store=('.npy',),
+                    align=64):
+    # write the files of folder to the zip archive zipName with the folder
+    # name as the root of the archive. Members are deflated at the given
+    # compression level (0 stores them) in a pool of jobs threads (zlib
+    # releases the GIL) and written sequentially in a single pass.
+    # Files with an extension in store are never compressed and their data
+    # starts at a multiple of align bytes in the archive so that they can be
+    # memory mapped
+    root = os.path.basename(os.path.normpath(folder))
+    members = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            arcname = os.path.join(root, os.path.relpath(path, folder))
+            members.append((path, arcname.replace(os.sep, '/')))
+    if sum([os.path.getsize(m[0]) for m in members]) > _ZIP_LIMIT:
+        # large archive, let zipfile handle zip64 extensions
+        with zipfile.ZipFile(zipName, 'w', allowZip64=True) as zf:
+            for path, arcname in members:
+                stored = level==0 or os.path.splitext(path)[1] in store
+                zf.write(path, arcname, [zipfile.ZIP_DEFLATED,
+                                         zipfile.ZIP_STORED][stored])
+        return
+    if jobs is None:
+        import multiprocessing
+        jobs = min(4, multiprocessing.cpu_count())
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, jobs))
+    central = []
+    try:
+        with open(zipName, 'wb') as f:
+            levels = [[level, 0][os.path.splitext(m[0])[1] in store]
+                      for m in members]
+            results = pool.imap(_compressMember,
+                                [(m[0], l) for m, l in zip(members, levels)])
+            for (path, arcname), lvl, (crc, size, chunks) in zip(
+                    members, levels, results):
+                st = os.stat(path)
+                date, tm = _dosDateTime(st.st_mtime)
+                name = arcname.encode('utf-8')
+                method = [8, 0][lvl==0]
+                csize = [sum([len(c) for c in chunks]), size][lvl==0]
+                offset = f.tell()
+                extra = b''
+                if lvl==0 and align:
+                    # pad with an extra field (zipalign id 0xD935)
+                    pad = -(offset+_ZIP_LOCAL.size+len(name))%align
+                    if 0 < pad < 4:
+                        pad += align
+                    if pad:
+                        extra = struct.pack('<HH', 0xD935, pad-4)+b'\0'*(pad-4)
+                f.write(_ZIP_LOCAL.pack(0x04034b50, 20, 0, method, tm, date,
+                                        crc, csize, size, len(name), len(extra)))
+                f.write(name)
+                f.write(extra)
+                if lvl:
+                    for c in chunks:
+                        f.write(c)
+                else:
+                    with open(path, 'rb') as src:
+                        shutil.copyfileobj(src, f, 1<<20)
+                central.append(_ZIP_CENTRAL.pack(
+                    0x02014b50, 3<<8|20, 20, 0, method, tm, date, crc, csize,
+                    size, len(name), 0, 0, 0, 0, (st.st_mode & 0xFFFF)<<16,
+                    offset)+name)
+            cdOffset = f.tell()
+            for c in central:
+                f.write(c)
+            f.write(_ZIP_END.pack(0x06054b50, 0, 0, len(central), len(central),
+                                  f.tell()-cdOffset, cdOffset, 0))
+    finally:
+        pool.close()
+        pool.join()
+
+def zipMemberDataOffset(f, info):
+    # return the offset in the open archive file f of the data of the
+    # member described by the ZipInfo info
+    f.seek(info.header_offset)
+    header = _ZIP_LOCAL.unpack(f.read(_ZIP_LOCAL.size))
+    return info.header_offset + _ZIP_LOCAL.size + header[9] + header[10]
+
+# binary maps can be encoded with reduced precision:
+#   'float32'  : the AutoGrid values
+#   'float16'  : half precision, values clipped to +/-65504
+#   'quantized': unsigned integers q with value = offset + q*scale where
+#                scale is twice the requested maximum error (uint16 when
+#                the range allows it, else uint32)
+# The maximum absolute error measured against the float32 values is kept
+# with the map description in data.pkl
+MAP_ENCODINGS = ('float32', 'float16', 'quantized')
+
+def encodeMap(data, encoding='float32', maxError=0.0005):
+    # return (array, info) with info holding the encoding, its parameters
+    # and the measured maxError
+    data = numpy.asarray(data, 'f')
+    info = {'encoding': encoding}
+    if encoding == 'float32':
+        info['maxError'] = 0.
+        return data, info
+    elif encoding == 'float16':
+        fmax = float(numpy.finfo(numpy.float16).max)
+        encoded = numpy.clip(data, -fmax, fmax).astype(numpy.float16)
+    elif encoding == 'quantized':
+        scale = 2*maxError
+        offset = float(data.min()) if data.size else 0.
+        levels = (float(data.max())-offset)/scale if data.size else 0.
+        if levels < 0xFFFF:
+            dtype = numpy.uint16
+        elif levels < 0xFFFFFFFF:
+            dtype = numpy.uint32
+        else: # range too large for the requested error
+            info['encoding'] = 'float32'
+            info['maxError'] = 0.
+            return data, info
+        encoded = numpy.round((data.astype('d')-offset)/scale).astype(dtype)
+        info['scale'] = scale
+        info['offset'] = offset
+    else:
+        raise ValueError('bad map encoding %s, expected one of %s'%(
+            encoding, ', '.join(MAP_ENCODINGS)))
+    if data.size:
+        info['maxError'] = float(numpy.max(numpy.abs(decodeMap(encoded, info)-data)))
+    else:
+        info['maxError'] = 0.
+    return encoded, info
+
+def decodeMap(encoded, info):
+    # return the float32 map of an array encoded by encodeMap. Decoded maps
+    # are plain in-memory arrays, even when encoded is a memmap
+    encoding = info.get('encoding', 'float32')
+    if encoding == 'quantized':
+        return numpy.asarray((info['offset']+encoded*info['scale']).astype('f'))
+    elif encoding == 'float16':
+        return numpy.asarray(encoded.astype('f'))
+    return encoded
+
+class TargetFile:
+    """
+    read access to a target (.trg) archive without extracting it. data.pkl,
+    the translation points and the maps are read on demand: members
+    stored uncompressed (float32 .npy maps) are memory mapped, the others
+    are streamed from the archive. Maps read into memory are kept in a
+    least recently used cache of at most maxBytes (default 512 MB).
+    """
+
+    def __init__(self, filename, maxBytes=512*1024**2):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self._zf = zipfile.ZipFile(filename)
+        self.root = self._zf.namelist()[0].split('/')[0]
+        self._data = None
+        from collections import OrderedDict
+        self._maps = OrderedDict() # mapType: (array, bytes counted)
+        self._cacheBytes = 0
+
+    def close(self):
+        self._maps.clear()
+        self._cacheBytes = 0
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def names(self):
+        # names of the files of the target, relative to its folder
+        n = len(self.root)+1
+        return [name[n:] for name in self._zf.namelist() if len(name) > n]
+
+    def member(self, name):
+        return self._zf.getinfo(self.root+'/'+name)
+
+    def read(self, name):
+        # content of a file of the target
+        return self._zf.read(self.member(name))
+
+    def open(self, name):
+        # file object streaming a file of the target
+        return self._zf.open(self.member(name))
+
+    def data(self):
+        # dictionary saved in data.pkl
+        if self._data is None:
+            self._data = pickle.loads(self.read('data.pkl'))
+        return self._data
+
+    def binaryMapInfo(self):
+        # {mapType: description} of the binary maps (see writeBinaryMaps)
+        info = {}
+        for mtype, desc in self.data().get('binaryMaps', {}).items():
+            desc = dict(desc)
+            desc['member'] = self.root+'/'+desc['file']
+            info[mtype] = desc
+        return info
+
+    def mapTypes(self):
+        # types of the maps available as binary or text maps
+        types = set(self.binaryMapInfo().keys())
+        for name in self.names():
+            if name.endswith('.map') and name.count('.') >= 2:
+                types.add(name.split('.')[-2])
+        return sorted(types)
+
+    def loadNpy(self, name):
+        # array of a .npy file of the target, memory mapped when stored
+        from numpy.lib import format as npyformat
+        zinfo = self.member(name)
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            with open(self.filename, 'rb') as f:
+                f.seek(zipMemberDataOffset(f, zinfo))
+                version = npyformat.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran, dtype = npyformat.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = npyformat.read_array_header_2_0(f)
+                offset = f.tell()
+            return numpy.memmap(self.filename, dtype=dtype, mode='r',
+                                offset=offset, shape=shape,
+                                order=['C', 'F'][fortran])
+        import io
+        return numpy.load(io.BytesIO(self._zf.read(zinfo)))
+
+    def translationPoints(self):
+        data = self.data()
+        name = os.path.basename(data.get('fillPointsFile', '') or 'translationPoints.npy')
+        return self.loadNpy(name)
+
+    def mapHeader(self, mtype):
+        # header dict (lines, spacing, nelements, center) of a map
+        info = self.binaryMapInfo()
+        if mtype in info:
+            desc = info[mtype]
+            return {'lines': desc['header'], 'spacing': desc['spacing'],
+                    'nelements': desc['nelements'], 'center': desc['center']}
+        f = self.open('rigidReceptor.%s.map'%mtype)
+        try:
+            return parseMapHeader([f.readline().decode('ascii') for i in range(MAP_HEADER_LINES)])
+        finally:
+            f.close()
+
+    def readMap(self, mtype, decode=True):
+        # read a map without caching it: the binary map when there is one
+        # (decoded to float32 unless decode is False), else the text map
+        info = self.binaryMapInfo()
+        if mtype in info:
+            data = self.loadNpy(info[mtype]['file'])
+            if decode:
+                data = decodeMap(data, info[mtype])
+            return data
+        f = self.open('rigidReceptor.%s.map'%mtype)
+        try:
+            return readMapStream(f)[1]
+        finally:
+            f.close()
+
+    def getMap(self, mtype):
+        # float32 map from the cache or read with readMap. Memory mapped
+        # maps are cached without counting against maxBytes
+        if mtype in self._maps:
+            entry = self._maps.pop(mtype)
+            self._maps[mtype] = entry
+            return entry[0]
+        info = self.binaryMapInfo()
+        data = self.readMap(mtype, decode=False)
+        # only a raw memmap of the archive costs no memory, decide before
+        # decoding since decoding reads the map into memory
+        mapped = isinstance(data, numpy.memmap)
+        if mtype in info:
+            decoded = decodeMap(data, info[mtype])
+            mapped = mapped and decoded is data
+            data = decoded
+        nbytes = [data.nbytes, 0][mapped]
+        if nbytes > self.maxBytes:
+            return data
+        while self._cacheBytes+nbytes > self.maxBytes and len(self._maps):
+            name, entry = self._maps.popitem(last=False)
+            self._cacheBytes -= entry[1]
+        self._maps[mtype] = (data, nbytes)
+        self._cacheBytes += nbytes
+        return data
+
+def loadTrgMaps(trgFile, mapTypes=None, decode=True):
+    # return a dict {mapType: array} of the binary maps of a target file.
+    # Maps stored uncompressed are returned as read-only numpy.memmap views
+    # of the archive, compressed ones are read into memory. Encoded maps
+    # are decoded to float32 arrays unless decode is False. Use
+    # TargetFile.binaryMapInfo to get the header (spacing, nelements,
+    # center) and the encoding of a map
+    with TargetFile(trgFile) as trg:
+        maps = {}
+        for mtype in trg.binaryMapInfo().keys():
+            if mapTypes is None or mtype in mapTypes:
+                maps[mtype] = trg.readMap(mtype, decode)
+        return maps
+
+##
+## on-disk cache of AutoGrid results
+##
+def atomIndices(atoms):
+    # list of the atom indices of a prody selection, None or empty list
+    if atoms is None or not len(atoms):
+        return []
+    return [int(i) for i in atoms.getIndices()]
+
+class GridCache:
+    """
+    content-addressed cache of AutoGrid map folders. Entries are keyed by a
+    hash of the receptor file content and of every parameter of the grid
+    calculation. When the cache grows beyond maxBytes the least recently
+    used entries are removed.
+    The folder defaults to $AGFR_GRID_CACHE or ~/.agfrGridCache and maxBytes
+    to $AGFR_GRID_CACHE_SIZE, the last size given for this folder or 10GB
+    """
+
+    def __init__(self, folder=None, maxBytes=None):
+        if folder is None:
+            folder = os.environ.get('AGFR_GRID_CACHE',
+                os.path.join(os.path.expanduser('~'), '.agfrGridCache'))
+        self.folder = folder
+        self._fileHashes = {}
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        if maxBytes is None and 'AGFR_GRID_CACHE_SIZE' in os.environ:
+            maxBytes = int(os.environ['AGFR_GRID_CACHE_SIZE'])
+        if maxBytes is None:
+            maxBytes = self._counters().get('maxBytes', 10*1024**3)
+        else:
+            self._count('maxBytes', maxBytes)
+        self.maxBytes = maxBytes
+
+    def hashFile(self, filename):
+        # sha1 of the file content, remembered for unchanged files
+        st = os.stat(filename)
+        k = (os.path.abspath(filename), st.st_mtime, st.st_size)
+        if k not in self._fileHashes:
+            self._fileHashes[k] = _sha1File(filename)
+        return self._fileHashes[k]
+
+    def key(self, receptorFile, center, size, spacing, atypes, smooth=0.5,
+            flexResStr=None, covalentExclude=None, atypesOnly=False):
+        params = {'receptor': self.hashFile(receptorFile),
+                  'center': ['%.4f'%x for x in center],
+                  'size': [int(x) for x in size],
+                  'spacing': '%.4f'%spacing,
+                  'atypes': sorted([str(x) for x in atypes]),
+                  'smooth': '%.4f'%smooth,
+                  'flexRes': flexResStr or '',
+                  'covalentExclude': [int(x) for x in covalentExclude or []],
+                  'atypesOnly': bool(atypesOnly)}
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('ascii')).hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.folder, key)
+
+    def fetch(self, key, folder, atypes=()):
+        # copy the cached files of key into folder. Returns the info dict
+        # given to store on a hit, None on a miss. Entries missing the map
+        # of one of atypes or the info, or evicted while being copied, are
+        # misses and leave nothing in folder
+        entry = self.entryPath(key)
+        tmp = None
+        try:
+            names = [n for n in os.listdir(entry) if not n.startswith('.')]
+            missing = [t for t in atypes if 'rigidReceptor.%s.map'%t not in names]
+            if missing or not os.path.exists(os.path.join(entry, '.info.json')):
+                shutil.rmtree(entry, ignore_errors=True) # let store replace it
+                raise OSError('cache entry %s is incomplete'%key)
+            with open(os.path.join(entry, '.info.json')) as f:
+                info = json.load(f)
+            tmp = tempfile.mkdtemp(dir=folder, prefix='.tmp')
+            for name in names:
+                shutil.copy(os.path.join(entry, name), tmp)
+            os.utime(entry, None) # mark as recently used
+            for name in names:
+                os.rename(os.path.join(tmp, name), os.path.join(folder, name))
+        except (EnvironmentError, ValueError):
+            self._count('misses')
+            return None
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+        self._count('hits')
+        return info
+
+    def store(self, key, folder, info=None):
+        # add the files of folder to the cache under key. info is a JSON
+        # serializable dict returned by fetch with the files
+        entry = self.entryPath(key)
+        if os.path.isdir(entry):
+            return
+        tmp = tempfile.mkdtemp(dir=self.folder, prefix='.tmp')
+        try:
+            for name in os.listdir(folder):
+                src = os.path.join(folder, name)
+                if os.path.isfile(src) and not name.startswith('.'):
+                    shutil.copy(src, tmp)
+            with open(os.path.join(tmp, '.info.json'), 'w') as f:
+                json.dump(info or {}, f)
+            os.rename(tmp, entry) # atomic, concurrent runs never see partial entries
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        # list of (lastUse, bytes, key) for all cache entries
+        result = []
+        for key in os.listdir(self.folder):
+            entry = self.entryPath(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            nbytes = sum([os.path.getsize(os.path.join(entry, name))
+                          for name in os.listdir(entry)])
+            result.append((os.path.getmtime(entry), nbytes, key))
+        return result
+
+    def evict(self):
+        # remove least recently used entries until the cache fits in maxBytes
+        entries = sorted(self.entries())
+        total = sum([e[1] for e in entries])
+        for lastUse, nbytes, key in entries:
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(self.entryPath(key), ignore_errors=True)
+            total -= nbytes
+            self._count('evictions')
+
+    def _counters(self):
+        try:
+            with open(os.path.join(self.folder, '.stats.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _count(self, name, value=None):
+        # increment a counter of the stats file, or set it to value
+        counters = self._counters()
+        if value is None:
+            value = counters.get(name, 0)+1
+        counters[name] = value
+        # write then rename so that concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.folder, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(counters, f)
+        os.rename(tmp, os.path.join(self.folder, '.stats.json'))
+
+    def stats(self):
+        entries = self.entries()
+        stats = self._counters()
+        stats.update({'folder': self.folder, 'entries': len(entries),
+                      'bytes': sum([e[1] for e in entries]),
+                      'maxBytes': self.maxBytes})
+        return stats
+
+def printGridCacheStats(folder=None):
+    stats = GridCache(folder).stats()
+    print('grid cache %s'%stats['folder'])
+    print('    entries  : %d'%stats['entries'])
+    print('    size     : %.1f MB of %.1f MB'%(stats['bytes']/1024.**2,
+                                               stats['maxBytes']/1024.**2))
+    lookups = stats['hits']+stats['misses']
+    print('    hits     : %d of %d lookups (%.1f%%)'%(
+        stats['hits'], lookups, 100.*stats['hits']/max(1, lookups)))
+    print('    evictions: %d'%stats['evictions'])
+    return stats
+
+def _forkPool(processes, maxtasksperchild=None, agfr=None):
+    # multiprocessing pool whose workers are forked from the current process
+    # so that they inherit loaded modules and the state of runAGFR objects.
+    # agfr is the runAGFR object of the workers (see _workerAGFR), handed
+    # to every worker when it starts
+    import multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(
+            processes, initializer=_setWorkerAGFR, initargs=(agfr,),
+            maxtasksperchild=maxtasksperchild)
+    return multiprocessing.Pool(processes, initializer=_setWorkerAGFR,
+                                initargs=(agfr,), maxtasksperchild=maxtasksperchild)
+
+# runAGFR object of a pool worker process, set by the pool initializer so
+# that pools started concurrently by several threads do not share it
+_workerAGFR = None
+
+def _setWorkerAGFR(agfr):
+    global _workerAGFR
+    _workerAGFR = agfr
+
+def _canForkPool():
+    # pools can only be created where fork() exists and outside of daemonic
+    # processes (e.g. the workers of another pool)
+    import multiprocessing
+    return hasattr(os, 'fork') and not multiprocessing.current_process().daemon
+
+def _forkProcess(target, args):
+    # start a non daemonic process forked from the current process, so that
+    # it can use pools of its own
+    import multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        p = multiprocessing.get_context('fork').Process(target=target, args=args)
+    else:
+        p = multiprocessing.Process(target=target, args=args)
+    p.daemon = False
+    p.start()
+    return p
+
+# AD4.2 atom types of the force field, see runAGFR.getAllADatomTypes
+_ADAtomTypes = None
+
+##
+## persistent worker service
+##
+# Jobs are JSON files holding the keyword arguments of runAGFR.__call__.
+# They are submitted to <queue>/new, claimed by renaming them into
+# <queue>/running and moved to <queue>/done or <queue>/failed with a
+# <job>.result.json status file and the <job>.out output of the run.
+# Several servers can share a queue.
+
+def warmUp():
+    # import the modules used to prepare receptors and read the force field
+    # parameters so that processes forked afterwards start ready (runAGFR
+    # itself only imports them when they are first used)
+    import MolKit2, prody
+    import ADFR, ADFR.utils.maps, ADFR.utils.MakeGrids, ADFR.utils.addGradients
+    import ADFR.utils.optParser, ADFR.AARotamers
+    import AutoSite.compositePoints, AutoSite.utils.clusterTPoints
+    import AutoSite.scoreClusters, AutoSite.shrink
+    import Support.version
+    runAGFR().getAllADatomTypes()
+
+def submitAGFRJob(queueDir, name=None, **kw):
+    # add a grid preparation job with the keyword arguments of
+    # runAGFR.__call__ to the queue. Returns the job name
+    newDir = os.path.join(queueDir, 'new')
+    if not os.path.exists(newDir):
+        os.makedirs(newDir)
+    if name is None:
+        name = '%s_%d_%s'%(datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+                           os.getpid(), hashlib.sha1(json.dumps(
+                               kw, sort_keys=True).encode('utf-8')).hexdigest()[:8])
+    tmp = os.path.join(queueDir, '.%s.json'%name)
+    with open(tmp, 'w') as f:
+        json.dump(kw, f)
+    os.rename(tmp, os.path.join(newDir, name+'.json'))
+    return name
+
+def _serveJob(args):
+    # run one queued job in a worker process forked from the server
+    queueDir, name = args
+    running = os.path.join(queueDir, 'running', name+'.json')
+    out = open(os.path.join(queueDir, 'running', name+'.out'), 'w')
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = out
+    t0 = time()
+    result = {'job': name, 'node': platform.node(), 'pid': os.getpid()}
+    try:
+        with open(running) as f:
+            kw = json.load(f)
+        runAGFR()(**kw)
+        result['status'] = 'done'
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time()-t0
+    sys.stdout, sys.stderr = stdout, stderr
+    out.close()
+    dest = os.path.join(queueDir, result['status'])
+    with open(os.path.join(dest, name+'.result.json'), 'w') as f:
+        json.dump(result, f, indent=1)
+    for ext in ('.json', '.out'):
+        os.rename(os.path.join(queueDir, 'running', name+ext),
+                  os.path.join(dest, name+ext))
+    return result
+
+def serveAGFR(queueDir, jobs=2, poll=1.0, maxJobs=None, verbose=True):
+    # run grid preparation jobs from the queue until the file <queue>/stop
+    # exists or maxJobs jobs have been started. Modules and force field
+    # parameters are loaded once and every job runs in a fresh process
+    # forked from this one, up to jobs at a time
+    for sub in ('new', 'running', 'done', 'failed'):
+        if not os.path.exists(os.path.join(queueDir, sub)):
+            os.makedirs(os.path.join(queueDir, sub))
+    t0 = time()
+    warmUp()
+    if verbose:
+        print('AGFR server %d ready in %.2f (sec), serving %s with %d processes'%(
+            os.getpid(), time()-t0, queueDir, jobs))
+    # jobs run in non daemonic processes so that they can start pools
+    # (pockets, map groups, gradients, ligand libraries)
+    running = []
+    started = 0
+    try:
+        while True:
+            for p, name in [r for r in running if not r[0].is_alive()]:
+                p.join()
+                running.remove((p, name))
+                if verbose:
+                    result = _serveJobResult(queueDir, name, p.exitcode)
+                    print('%s %s in %.2f (sec)'%(result['job'], result['status'],
+                                                 result.get('seconds', 0.)))
+            if os.path.exists(os.path.join(queueDir, 'stop')) or \
+                   (maxJobs is not None and started >= maxJobs):
+                if not running:
+                    break
+            elif len(running) < jobs:
+                for path in sorted(glob(os.path.join(queueDir, 'new', '*.json'))):
+                    name = os.path.splitext(os.path.basename(path))[0]
+                    try: # claim the job, fails if another server got it first
+                        os.rename(path, os.path.join(queueDir, 'running', name+'.json'))
+                    except OSError:
+                        continue
+                    running.append((_forkProcess(_serveJob, ((queueDir, name),)), name))
+                    started += 1
+                    break
+                else:
+                    sleep(poll)
+                continue
+            sleep(poll)
+    finally:
+        for p, name in running:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+def _serveJobResult(queueDir, name, exitcode=None):
+    # return the result of a finished job, a job whose process died before
+    # writing its result is reported as failed
+    for status in ('done', 'failed'):
+        filename = os.path.join(queueDir, status, name+'.result.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                return json.load(f)
+    return {'job': name, 'status': 'failed',
+            'error': 'worker exited with code %s'%exitcode}
+
+def _workerPhases(agfr):
+    # phases profiled by a worker process, tagged with its pid, to be
+    # merged into the profiler of the parent process
+    pid = os.getpid()
+    return [dict(record, pid=pid) for record in agfr.profiler.phases]
+
+def _pocketGridsWorker(job):
+    # compute the grids and target file for one pocket in a worker process.
+    # Returns (n, filename, status, seconds, message) and the profiled phases
+    n, filename, boxCenter, boxSize, boxLengths, fillPoints, flexResStr, \
+       spacing = job
+    agfr = _workerAGFR
+    agfr.profiler.phases = [] # forked with the phases of the parent
+    agfr.echo = False
+    agfr.summaryFP = open(filename+'.log', 'w')
+    agfr.boxCenter = boxCenter
+    agfr.boxSize = boxSize
+    agfr.boxLengths = boxLengths
+    agfr.fillPoints = fillPoints
+    t0 = time()
+    try:
+        gc, status = agfr.computeGrids(filename, flexResStr, spacing,
+                                       indent="    ")
+        msg = agfr.gridsStatusMessage(gc, status)
+    except Exception as e:
+        status = -1
+        msg = 'pocket %d: %s'%(n, e)
+        agfr.myprint('ERROR: %s'%msg)
+    agfr.summaryFP.close()
+    if status != 0 and not msg:
+        msg = 'pocket %d failed'%n
+    return (n, filename, status, time()-t0, msg), _workerPhases(agfr)
+
+def _typeGroupWorker(job):
+    # compute the maps of a group of atom types in a worker process.
+    # Returns (folder, atypes, status, seconds, message) and the profiled
+    # phases
+    center, size, spacing, atypes, flexResStr, folder = job
+    agfr = _workerAGFR
+    agfr.profiler.phases = [] # forked with the phases of the parent
+    agfr.echo = False
+    agfr.summaryFP = None
+    t0 = time()
+    try:
+        with agfr.profiler.phase('atom type group', atypes=list(atypes)):
+            gc, status = agfr._computeGrids(center, size, spacing, atypes,
+                                            flexResStr=flexResStr,
+                                            folder=folder, atypesOnly=True)
+        msg = agfr.gridsStatusMessage(gc, status)
+    except Exception as e:
+        status = -1
+        msg = 'maps %s: %s'%(' '.join(atypes), e)
+    return (folder, atypes, status, time()-t0, msg), _workerPhases(agfr)
+
+def _gradientWorker(job):
+    # add the gradient to one map in a worker process, logging to logFile
+    mapFile, mtype, spacing, cutOffValue, errorCut, logFile = job
+    from ADFR.utils.addGradients import addGradientToMaps
+    t0 = time()
+    try:
+        addGradientToMaps([mapFile], [mtype], spacing, cutOffValue,
+                          errorCut=errorCut, logFileName=logFile)
+        msg = ''
+    except Exception as e:
+        msg = 'gradient %s: %s'%(mtype, e)
+    return mtype, time()-t0, msg
+
+##
+## map types of ligand libraries
+##
+# setMapTypes('library:<spec>') uses the AD atom types found in the ligands
+# of a library. spec is a comma separated list of directories (searched
+# recursively for .pdbqt files), .pdbqt files, glob patterns or text files
+# listing one ligand file per line. The types of every ligand file are
+# cached with its size and mtime in $AGFR_LIBRARY_CACHE (default
+# ~/.agfrLibraryTypes), one JSON file per library, so that only new or
+# modified ligands are read again.
+
+def libraryLigandFiles(spec):
+    # return the sorted list of ligand files of a library specification
+    files = set()
+    for item in spec.split(','):
+        item = os.path.expanduser(item.strip())
+        if not item:
+            continue
+        if os.path.isdir(item):
+            for root, dirs, names in os.walk(item):
+                for name in names:
+                    if name.endswith('.pdbqt'):
+                        files.add(os.path.abspath(os.path.join(root, name)))
+        elif item.endswith('.pdbqt'):
+            files.update([os.path.abspath(x) for x in glob(item)])
+        elif os.path.isfile(item):
+            folder = os.path.dirname(os.path.abspath(item))
+            with open(item) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        files.add(os.path.abspath(os.path.join(folder, line)))
+        else:
+            files.update([os.path.abspath(x) for x in glob(item)])
+    return sorted(files)
+
+def pdbqtADTypes(filename):
+    # return the sorted AD atom types of the ATOM/HETATM records of a
+    # PDBQT file (the type follows the charge, from column 78 on)
+    types = set()
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                w = line[77:].split()
+                if len(w):
+                    types.add(w[0])
+    return sorted(types)
+
+def _ligandTypesWorker(filename):
+    try:
+        return filename, pdbqtADTypes(filename), ''
+    except (IOError, OSError) as e:
+        return filename, [], str(e)
+
+def libraryADTypes(spec, jobs=None, cacheFolder=None, verbose=False):
+    # return the sorted union of the AD atom types of the ligands of a
+    # library. Ligand files are read in jobs processes (default number of
+    # CPUs) unless their types are cached
+    files = libraryLigandFiles(spec)
+    if not len(files):
+        raise ValueError('no ligand files found for library %s'%spec)
+    if cacheFolder is None:
+        cacheFolder = os.environ.get('AGFR_LIBRARY_CACHE',
+            os.path.join(os.path.expanduser('~'), '.agfrLibraryTypes'))
+    cacheFile = os.path.join(cacheFolder, hashlib.sha1(
+        spec.encode('utf-8')).hexdigest()+'.json')
+    cache = {}
+    if os.path.exists(cacheFile):
+        try:
+            with open(cacheFile) as f:
+                cache = json.load(f)['files']
+        except (IOError, ValueError, KeyError):
+            cache = {}
+    entries = {}
+    toRead = []
+    for name in files:
+        try:
+            st = os.stat(name)
+        except OSError:
+            raise ValueError('ligand file %s of library %s not found'%(name, spec))
+        entry = cache.get(name)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            entries[name] = entry
+        else:
+            entries[name] = [st.st_size, st.st_mtime, None]
+            toRead.append(name)
+    if len(toRead):
+        if jobs is None:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        t0 = time()
+        if jobs > 1 and len(toRead) > 1 and _canForkPool():
+            pool = _forkPool(min(jobs, len(toRead)))
+            try:
+                results = pool.map(_ligandTypesWorker, toRead,
+                                   chunksize=max(1, len(toRead)//(4*jobs)))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [_ligandTypesWorker(name) for name in toRead]
+        for name, types, msg in results:
+            if msg:
+                raise ValueError('could not read ligand %s: %s'%(name, msg))
+            entries[name][2] = types
+        if verbose:
+            print('read atom types of %d ligands in %.2f (sec), %d cached'%(
+                len(toRead), time()-t0, len(files)-len(toRead)))
+        try:
+            if not os.path.exists(cacheFolder):
+                os.makedirs(cacheFolder)
+            tmp = '%s.tmp%d'%(cacheFile, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'library': spec, 'files': entries}, f)
+            os.rename(tmp, cacheFile)
+        except (IOError, OSError):
+            pass # the cache is optional
+    types = set()
+    for entry in entries.values():
+        types.update([str(t) for t in entry[2]])
+    return sorted(types)
 
 errorCodes = {0:   """ready to compute grids""",
               100: """please load a receptor""",
@@ -76,7 +1818,10 @@ errorCodes = {0:   """ready to compute grids""",
               107: """map types are not specified""",
               108: """atoms defining a chi angle not found in receptor""",
               109: """please specify atoms forming the covalent ligand attachment bond""",
-              110: """One or more residues cannot be made flexible"""}
+              110: """One or more residues cannot be made flexible""",
+              111: """the receptor file contains a torsion tree, it is a ligand""",
+              112: """the ligand file has no torsion tree, it is a receptor""",
+              113: """flexible residue not found in receptor"""}
 
 actionRecommendedGui = {0: """Compute grids""",
                         100: """load .pdbqt receptor file""",
@@ -89,7 +1834,10 @@ actionRecommendedGui = {0: """Compute grids""",
                         107: """select map types""",
                         108: """ """,
                         109: """Select covalent bond atoms""",
-                        110: """Check flexible residues list"""}                  
+                        110: """Check flexible residues list""",
+                        111: """load a .pdbqt receptor file""",
+                        112: """load a .pdbqt ligand file""",
+                        113: """Check flexible residues list"""}                  
 
 actionRecommended = {0: """computeGrids(outFile, flexResStr, spacing, background=False, indent='')""",
                      100: """loadReceptor(filename)""",
@@ -102,20 +1850,35 @@ actionRecommended = {0: """computeGrids(outFile, flexResStr, spacing, background
                      107: """setMapTypes(maptype ).\n---maptype can be  'all' or 'ligand' or [list of atom types]""",
                      108: """ """,
                      109: """ """,
-                     110: """Check flexible residues list"""
+                     110: """Check flexible residues list""",
+                     111: """loadReceptor(filename)""",
+                     112: """loadLigand(filename)""",
+                     113: """setFlexResidues(flexresStr)\n flexresStr example: 'A:ILE10,GLU34'"""
                      }
 
+# AutoSite scratch folders not removed yet, removed at exit at the latest
+_autoSiteScratch = set()
+
+def _removeAutoSiteScratch(folders=None):
+    for folder in list(_autoSiteScratch if folders is None else folders):
+        shutil.rmtree(folder, ignore_errors=True)
+        _autoSiteScratch.discard(folder)
+
+atexit.register(_removeAutoSiteScratch)
+
 class runAGFR:
     """
     class to run AGFR from command line
     """
 
     def myprint(self, str, newline=True):
-        sys.stdout.write(str)
+        if self.echo:
+            sys.stdout.write(str)
         if self.summaryFP:
             self.summaryFP.write(str)
         if newline:
-            sys.stdout.write('\n')
+            if self.echo:
+                sys.stdout.write('\n')
             if self.summaryFP:
                 self.summaryFP.write('\n')
 
@@ -125,8 +1888,20 @@ class runAGFR:
         f.write('\n')
         f.close()
 
+    def reportPocketStats(self, line, filenameBase, header=False):
+        # add a line of pocket statistics to the results sink, or append it
+        # to <filenameBase>_pockets.csv when there is no sink
+        if self.resultsSink is None:
+            self.report(line, filenameBase+'_pockets.csv')
+        elif header:
+            self.resultsSink.setStatsHeader(line)
+        else:
+            self.resultsSink.addStats(line)
+
     def __init__(self):
         self.summaryFP = None
+        self.resultsSink = None # PocketResultsSink used by __call__
+        self.echo = True # when False myprint only writes to the log file
         self.receptor = None
         self.ligand = None
         self.boxCenter = None
@@ -147,23 +1922,101 @@ class runAGFR:
         self._wMapEntropy = -0.2 
         self._wMapWeight = 0.6
         self.cutOffValue = None
+        self._recordIndex = None
+        self._residueIndex = None
+        self.gridCache = None # GridCache instance used by _computeGrids
+        self.trgCompressLevel = 6 # 0 stores the files of .trg archives
+        self.trgCompressJobs = None # threads compressing .trg members
+        self.mapFormat = 'text' # 'text', 'binary' or 'both' maps in .trg files
+        self.profiler = PhaseProfiler(enabled=False)
+        self.clusteringEngine = 'autosite' # 'kdtree' or 'celllist' for FillPointClustering
+        self.receptorCache = False # use the binary receptor cache in loadReceptor
+        self._scratchFolders = [] # AutoSite folders created by AutoSiteFill
+        self.autoSiteMaps = None # description of the last AutoSite maps
+        self.mapJobs = 1 # processes computing the maps of a grid
+        self.mapEncoding = 'float32' # encoding of binary maps, see MAP_ENCODINGS
+        self.mapMaxError = 0.0005 # maximum error of quantized maps
+        self.gradientJobs = 1 # processes adding the gradient to the maps
         
+    def setTrgCompression(self, level=None, jobs=None):
+        # zlib compression level (0-9, 0 for store only) and number of
+        # threads used to write .trg archives
+        if level is not None:
+            assert 0 <= level <= 9
+            self.trgCompressLevel = level
+        if jobs is not None:
+            self.trgCompressJobs = jobs
+
+    def setMapFormat(self, mapFormat):
+        # store AutoGrid text maps ('text', the default), .npy maps
+        # ('binary', see setMapEncoding) or both in target files. Binary
+        # maps are memory mapped by TargetFile but make targets larger
+        assert mapFormat in ('text', 'binary', 'both')
+        self.mapFormat = mapFormat
+
+    def setGridCache(self, folder=None, maxBytes=None):
+        # enable reusing AutoGrid maps from the on-disk cache
+        self.gridCache = GridCache(folder, maxBytes)
+
+    def setReceptorCache(self, flag=True):
+        # read receptors from, and save them to, the binary cache next to
+        # the receptor file
+        self.receptorCache = flag
+
     def loadReceptor(self, filename):
+        if self.receptorCache:
+            # a cached receptor already passed the ligand check
+            mol = loadCachedReceptor(filename)
+            if mol is not None:
+                self.myprint('    using cached receptor %s'%receptorCacheFiles(filename)[0])
+                self.setReceptor(mol)
+                return
         # make sure receptor is not a ligand and if so load it
+        from ADFR import checkLigandFile
         if checkLigandFile(filename):
             self.myprint("ERROR: the file %s contains a torsion tree indicating this is a ligand."%filename)
             raise ValueError("the file %s contains a torsion tree indicating this is a ligand."%filename)
-        self.setReceptor(Read(filename))
+        from MolKit2 import Read
+        mol = Read(filename)
+        if self.receptorCache and not saveCachedReceptor(mol, filename):
+            self.myprint('    WARNING: could not write receptor cache for %s'%filename)
+        self.setReceptor(mol)
 
     def setReceptor(self, mol):
         self.receptor = mol
+        self._recordIndex = None
+        self.autoSiteMaps = None # computed for another receptor
         self.data['inputReceptor'] = os.path.basename(mol.filename)
 
+    def getResidueIndex(self):
+        # {(chid, resname, resnum): {atomName: [atomIndex, ...]}} for the
+        # receptor, built on first use. Alternate locations and duplicate
+        # names keep all their atoms, first one first. Chain identifiers
+        # are stripped
+        if self._residueIndex is None or self._residueIndex[0] is not self.receptor:
+            ag = self.receptor._ag
+            index = {}
+            for i, (chid, resname, resnum, name) in enumerate(zip(
+                    ag.getChids().tolist(), ag.getResnames().tolist(),
+                    ag.getResnums().tolist(), ag.getNames().tolist())):
+                index.setdefault((chid.strip(), resname, resnum), {}).setdefault(name, []).append(i)
+            self._residueIndex = (self.receptor, index)
+        return self._residueIndex[1]
+
+    def getRecordIndex(self):
+        # ATOM/HETATM record index of the receptor file, built on first use
+        if self._recordIndex is None or \
+               self._recordIndex.filename != self.receptor.filename:
+            self._recordIndex = ATOMRecordIndex(self.receptor.filename)
+        return self._recordIndex
+
     def loadLigand(self, filename):
         # check if a ligand is provided and loaded if so
+        from ADFR import checkLigandFile
         if not checkLigandFile(filename):
             self.myprint("ERROR: the file %s does not contain a torsion tree indicating this is a receptor."%filename)
             raise ValueError("the file %s does not contain a torsion tree indicating this is a receptor."%filename)
+        from MolKit2 import Read
         self.setLigand(Read(filename))
 
     def setLigand(self, mol):
@@ -230,6 +2083,8 @@ class runAGFR:
         elif mode[0]=="fill":
             coords = self.fillPoints
         elif mode[0]=="residues":
+            from ADFR.utils.maps import flexResStr2flexRes
+            from ADFR.utils.MakeGrids import splitFlexRes
             flexRes = flexResStr2flexRes(mode[1])
             receptorAtoms, sideChainAtoms = splitFlexRes(self.receptor, flexRes,
                                                          exclude='')
@@ -272,9 +2127,23 @@ class runAGFR:
             padding = self.padding
         if spacing is None:
             spacing = self.spacing
+        self.boxCenter, self.boxSize, self.boxLengths = self.boxForCoords(
+            coords, padding, spacing)
+        self.padding = padding
+        self.spacing = spacing
+        
+        self.data['boxPadding'] = padding
+        self.data['boxCenter'] = self.boxCenter
+        self.data['boxLengths'] = self.boxLengths
+        self.data['boxSize'] = self.boxSize
+        self.data['spacing'] = spacing
+
+    def boxForCoords(self, coords, padding, spacing):
+        # return (center, size, lengths) of the smallest box encompassing
+        # coords, without changing the box of this object
         mini = numpy.min(coords, 0)
         maxi = numpy.max(coords, 0)
-        self.boxCenter = 0.5*(mini+maxi)
+        center = 0.5*(mini+maxi)
         boxLengths = (maxi-mini) + 2*padding # needed length
         # size is th number of grid intervals to cover needed length
         # + 1 to make it grid points
@@ -284,21 +2153,14 @@ class runAGFR:
             if n%2==1:
                 n+=1 # make it even
             s.append(n)
-        self.boxSize = s
-        self.padding = padding
-        self.spacing = spacing
-        self.boxLengths = numpy.array([x*spacing for x in self.boxSize])
-        
-        self.data['boxPadding'] = padding
-        self.data['boxCenter'] = self.boxCenter
-        self.data['boxLengths'] = self.boxLengths
-        self.data['boxSize'] = self.boxSize
-        self.data['spacing'] = spacing
+        return center, s, numpy.array([x*spacing for x in s])
 
     def setCovalentDocking(self, torsionAtIndex,
                            covBondAtIndex, #serial indices of two covalent bond atoms
                            covResStr=None, toRemoveAtoms=None):
         #print "setCovalentDocking:", torsionAtIndex, covBondAtIndex
+        from prody.atomic.atom import Atom
+        from ADFR.utils.maps import flexResStr2flexRes
         id1 = self.receptor.select('serial %d'%covBondAtIndex[0]).getIndices()[0]
         at1 = Atom(self.receptor._ag, id1, 0)
         id2 = self.receptor.select('serial %d'%covBondAtIndex[1]).getIndices()[0]
@@ -329,19 +2191,24 @@ class runAGFR:
         self.covalentBondToExclude = toRemoveAtoms
 
     def getAllADatomTypes(self):
-        from ADFRcc import getFFParameters
-        parameters = getFFParameters()
-        self.ADAtomTypes = {}
-        #import pdb;pdb.set_trace()
-        # MS. March 2016 restrict types to AD4.2 types for now
-        AD42atomTypes = {}.fromkeys(
-            ['H', 'HD', 'HS', 'C', 'A', 'N', 'NA', 'NS', 'OA', 'OS', 'F',
-             'Mg', 'MG', 'P', 'SA', 'S', 'Cl', 'CL', 'Ca', 'CA', 'Mn', 'MN',
-             'Fe', 'FE', 'Zn', 'ZN', 'Br', 'BR', 'I', 'Z', 'G', 'GA', 'J', 'Q'])
-        for i in range(parameters.numAtomTypes):
-            atype = parameters.getAtomTypeByIndex(i).atomTypeName
-            if atype in AD42atomTypes:
-                self.ADAtomTypes[atype] = True
+        # the force field parameters are read once per process
+        global _ADAtomTypes
+        if _ADAtomTypes is None:
+            from ADFRcc import getFFParameters
+            parameters = getFFParameters()
+            types = {}
+            #import pdb;pdb.set_trace()
+            # MS. March 2016 restrict types to AD4.2 types for now
+            AD42atomTypes = {}.fromkeys(
+                ['H', 'HD', 'HS', 'C', 'A', 'N', 'NA', 'NS', 'OA', 'OS', 'F',
+                 'Mg', 'MG', 'P', 'SA', 'S', 'Cl', 'CL', 'Ca', 'CA', 'Mn', 'MN',
+                 'Fe', 'FE', 'Zn', 'ZN', 'Br', 'BR', 'I', 'Z', 'G', 'GA', 'J', 'Q'])
+            for i in range(parameters.numAtomTypes):
+                atype = parameters.getAtomTypeByIndex(i).atomTypeName
+                if atype in AD42atomTypes:
+                    types[atype] = True
+            _ADAtomTypes = types
+        self.ADAtomTypes = dict(_ADAtomTypes)
 
     def setMapTypes(self, mapTypes):
         if mapTypes=='all':
@@ -359,6 +2226,12 @@ class runAGFR:
                 self.atypes = numpy.unique(self.ligand._ag.getData('AD_element'))
         elif isinstance(mapTypes, list):
             self.atypes = mapTypes
+        elif hasattr(mapTypes, 'startswith') and mapTypes.startswith('library:'):
+            # union of the atom types of the ligands to dock
+            self.atypes = libraryADTypes(mapTypes[8:])
+            self.data['mapTypesLibrary'] = mapTypes[8:]
+            self.myprint('    %d atom types found in ligand library %s'%(
+                len(self.atypes), mapTypes[8:]))
         for tt in ["OA", "HD"]:  #make sure these map types are always in the list of selected maptypes.
             # the OA and HD maps will be used to create water map file in the trg file.
             if tt not in self.atypes:
@@ -380,6 +2253,8 @@ class runAGFR:
                       flexResStr=None, folder='.', atypesOnly=False,
                       background=False, fp=False, outlev=1):
         # flexResStr is a string like this "A:ILE10,GLU34"
+        from ADFR.utils.maps import flexResStr2flexRes
+        from AutoSite.compositePoints import CompositePoints
         flexRes = flexResStr2flexRes(flexResStr)
         #print "FLEXRES", flexResStr, flexRes, len(flexRes)
         gc = CompositePoints(
@@ -387,7 +2262,28 @@ class runAGFR:
             smooth=smooth, flexibleResidues=flexRes,
             folder=folder, atypesOnly=atypesOnly, fp=fp,
             covalentBondToExclude=self.covalentBondToExclude, outlev=outlev)
+        # fill point (AutoSite) runs keep state in gc and are not cached
+        key = None
+        if self.gridCache is not None and not background and not fp:
+            exclude = self.covalentBondToExclude
+            if hasattr(exclude, 'getIndices'):
+                exclude = exclude.getIndices()
+            key = self.gridCache.key(self.receptor.filename, center, size,
+                                     spacing, atypes, smooth, flexResStr,
+                                     exclude, atypesOnly)
+            info = self.gridCache.fetch(key, folder, atypes)
+            if info is not None:
+                # gc did not run, give it the atoms its run left out of the
+                # grid calculation, as generateTrgFile reads them
+                gc.flexRecAtoms = self.atomsFromIndices(info['flexRecAtoms'])
+                gc.covalentLigAtoms = self.atomsFromIndices(info['covalentLigAtoms'])
+                self.myprint("using cached maps %s"%key)
+                return gc, 0
         status, msg = gc.run(background=background)
+        if status==0 and key is not None:
+            self.gridCache.store(key, folder, {
+                'flexRecAtoms': atomIndices(getattr(gc, 'flexRecAtoms', None)),
+                'covalentLigAtoms': atomIndices(getattr(gc, 'covalentLigAtoms', None))})
 
         if status!=0:
             self.myprint("ERROR: running autogrid failed in %s."%gc.folder)
@@ -402,6 +2298,64 @@ class runAGFR:
         #    gc.addFlexRecHeader('FLEXRES "%s"'%flexResStr)
         return gc, status
 
+    def setMapJobs(self, jobs):
+        # number of processes computing the atom type maps of a grid
+        assert jobs >= 1
+        self.mapJobs = jobs
+
+    def _computeGridsByType(self, center, size, spacing, atypes, jobs,
+                            flexResStr=None, folder='.', outlev=1):
+        # compute the maps of atypes split into jobs groups concurrently.
+        # The first group is computed with the e and d maps in folder by
+        # this process, the other groups by forked processes in sub folders
+        # whose maps are then moved to folder. Returns the (gc, status) of
+        # the first group, status is not 0 if any group failed. The maps
+        # are computed serially when no pool can be started
+        groups = [g for g in [list(atypes[i::jobs]) for i in range(jobs)] if len(g)]
+        # pools can not be started in daemonic processes, e.g. pocket workers
+        if len(groups) < 2 or not _canForkPool():
+            return self._computeGrids(center, size, spacing, atypes,
+                                      flexResStr=flexResStr, folder=folder,
+                                      outlev=outlev)
+        groupJobs = []
+        for n, group in enumerate(groups[1:]):
+            sub = os.path.join(folder, 'atypes%d'%(n+1))
+            os.mkdir(sub)
+            groupJobs.append((center, size, spacing, group, flexResStr, sub))
+        self.myprint('    computing maps for %d atom types using %d processes'%(
+            len(atypes), len(groups)))
+        # flush buffered output so that forked workers do not write it again
+        sys.stdout.flush()
+        if self.summaryFP:
+            self.summaryFP.flush()
+        pool = _forkPool(len(groupJobs), agfr=self)
+        try:
+            pending = pool.map_async(_typeGroupWorker, groupJobs)
+            gc, status = self._computeGrids(center, size, spacing, groups[0],
+                                            flexResStr=flexResStr,
+                                            folder=folder, outlev=outlev)
+            results = []
+            for result, phases in pending.get():
+                self.profiler.phases.extend(phases)
+                results.append(result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        fldFiles = glob(os.path.join(folder, '*.fld'))
+        for sub, group, groupStatus, dt, msg in results:
+            if groupStatus != 0:
+                self.myprint('ERROR: %s'%(msg or 'maps %s failed'%' '.join(group)))
+                if status == 0:
+                    status = groupStatus
+            elif len(fldFiles):
+                # list the maps of the group in the grid's field file
+                mergeFieldFiles(fldFiles[0], glob(os.path.join(sub, '*.fld')))
+            for name in glob(os.path.join(sub, '*.map')):
+                shutil.move(name, os.path.join(folder, os.path.basename(name)))
+            shutil.rmtree(sub, ignore_errors=True)
+        return gc, status
+
     ##
     ## AutoSite computing methods
     ##
@@ -412,14 +2366,77 @@ class runAGFR:
         
         size = [int(ceil(x/spacing)) for x in length]
         #print "SIZE", size
-        self.tmpFolder = tempfile.mktemp()
-        os.mkdir(self.tmpFolder)
+        self.tmpFolder = tempfile.mkdtemp(prefix='agfrAutoSite')
+        self._scratchFolders.append(self.tmpFolder)
+        _autoSiteScratch.add(self.tmpFolder)
+        atypes = ['C','OA','HD']
         gc, status = self._computeGrids(
-            center, size, atypes=['C','OA','HD'], spacing=spacing,
+            center, size, atypes=atypes, spacing=spacing,
             smooth=smooth, flexResStr=flexResStr, folder=self.tmpFolder,
             atypesOnly=True, fp=True, background=background, outlev=outlev)
+        self.autoSiteMaps = None
+        if status == 0 and not background and not len(self.covalentBondToExclude):
+            # remember the maps so that computeGrids can reuse them
+            self.autoSiteMaps = {'folder': self.tmpFolder, 'atypes': atypes,
+                                 'receptor': self.receptor,
+                                 'receptorFile': self.receptorFileKey(),
+                                 'center': [float(x) for x in center],
+                                 'size': list(size), 'spacing': spacing,
+                                 'smooth': smooth, 'flexResStr': flexResStr}
         return gc, status
 
+    @contextmanager
+    def autoSiteScratch(self):
+        # with agfr.autoSiteScratch(): ...
+        # removes the AutoSite folders created inside the block when it exits
+        n = len(self._scratchFolders)
+        try:
+            yield
+        finally:
+            folders = self._scratchFolders[n:]
+            del self._scratchFolders[n:]
+            if self.autoSiteMaps is not None and self.autoSiteMaps['folder'] in folders:
+                self.autoSiteMaps = None
+            _removeAutoSiteScratch(folders)
+
+    def atomsFromIndices(self, indices):
+        # prody selection of the receptor atoms with these indices, an
+        # empty list when there are none
+        if not len(indices):
+            return []
+        return self.receptor._ag.select('index %s'%' '.join([str(i) for i in indices]))
+
+    def receptorFileKey(self):
+        # (path, mtime, size) of the receptor file, None when it can not be
+        # read
+        try:
+            st = os.stat(self.receptor.filename)
+        except (OSError, AttributeError):
+            return None
+        return (os.path.abspath(self.receptor.filename), st.st_mtime, st.st_size)
+
+    def reusableAutoSiteMaps(self, center, size, spacing, flexResStr, smooth=0.5):
+        # return the folder and the atom types of the AutoSite maps computed
+        # for the same receptor, box, spacing, smoothing and flexible
+        # residues, or (None, []) when they can not be reused.
+        # AutoSiteFill computes them with the same _computeGrids call as
+        # computeGrids (CompositePoints with atypesOnly), fp=True only asks
+        # CompositePoints to also compute the fill points from these maps
+        asm = self.autoSiteMaps
+        if asm is None or len(self.covalentBondToExclude) or \
+               not os.path.isdir(asm['folder']):
+            return None, []
+        key = self.receptorFileKey()
+        if asm['receptor'] is not self.receptor or key is None or \
+               asm['receptorFile'] != key:
+            return None, []
+        if asm['spacing'] != spacing or asm['smooth'] != smooth or \
+               asm['flexResStr'] != flexResStr or \
+               list(asm['size']) != [int(x) for x in size] or \
+               not numpy.allclose(asm['center'], center, atol=1e-6):
+            return None, []
+        return asm['folder'], asm['atypes']
+
     def runAutoSite(self, flexResStr=None, smooth=0.5,
                     spacing=1.0, verbose=False, background=False, outlev=1):
         #tpoints = None
@@ -435,7 +2452,15 @@ class runAGFR:
         # finishes
         return gc, status
 
+    def runAutoSiteAsync(self, scheduler, **kw):
+        # submit runAutoSite (keyword arguments of runAutoSite except
+        # background) to an AGFRJobScheduler. The future's result is
+        # (gc, status)
+        kw['background'] = False
+        return scheduler.submit(self.runAutoSite, **kw)
+
     def afterAutoSite2(self, gc, spacing=1.0, cutoff=10, ligandSize=500, pepScore=False, verbose=False, filenameBase=sys.stdout):
+        from AutoSite.scoreClusters import scoreClusters
         dcl, headNode = gc.bestCutoffClustering(self.receptor,spacing=spacing,carbon_cutoff=-0.36,oxygen_cutoff=-0.792,hydrogen_cutoff=-0.6,nbSteps=4)
         clusters, clProp = scoreClusters(self.receptor, dcl, gc,inflate=True, pepScore = pepScore)
         nbp = numpy.sum(dcl._clen)
@@ -462,10 +2487,10 @@ class runAGFR:
             self.myprint('    pocket|  energy | # of |Rad. of | energy |   bns    | score  ')
             if pepScore:
                 self.myprint('    number|         |points|gyration|per vol.|buriedness|v*b^1.5 ')
-                self.report('pocket_number,energy,no_Points,rad_gyr,energy_per_vol,bns_buriedness,score_v*b^1.5',filenameBase+'_pockets.csv') ## DB0531
+                self.reportPocketStats('pocket_number,energy,no_Points,rad_gyr,energy_per_vol,bns_buriedness,score_v*b^1.5',filenameBase, header=True) ## DB0531
             else:
                 self.myprint('    number|         |points|gyration|per vol.|buriedness|v*b^2/rg')
-                self.report('pocket_number,energy,no_Points,rad_gyr,energy_per_vol,bns_buriedness,score_v*b^2/rg',filenameBase+'_pockets.csv') ## DB0531
+                self.reportPocketStats('pocket_number,energy,no_Points,rad_gyr,energy_per_vol,bns_buriedness,score_v*b^2/rg',filenameBase, header=True) ## DB0531
             self.myprint('    ------+---------+------+--------+--------+----------+---------')
             n = 0
             for cl, clp in zip(clustersorted, clPropsorted):
@@ -473,17 +2498,29 @@ class runAGFR:
                 self.myprint('     %4d %9.2f %5d %7.2f   %7.2f    %6.2f    %7.2f'%(
                     n,clp[0],clp[1],clp[3],clp[2],clp[4],clp[5]))
 
-                self.report('%d,%f,%d,%f,%f,%f,%f'%(
-                    n,clp[0],clp[1],clp[3],clp[2],clp[4],clp[5]),filenameBase+'_pockets.csv')  ## DB0531
+                self.reportPocketStats('%d,%f,%d,%f,%f,%f,%f'%(
+                    n,clp[0],clp[1],clp[3],clp[2],clp[4],clp[5]),filenameBase)  ## DB0531
         return  clustersorted, clPropsorted, dcl
 
 
+    def setClusteringEngine(self, engine):
+        # engine clustering the fill points of AutoSite 1.0: 'autosite'
+        # (DensityClustering), 'kdtree' or 'celllist' (FillPointClustering)
+        assert engine in ('autosite', 'kdtree', 'celllist')
+        self.clusteringEngine = engine
+
     def afterAutoSite(self, gc, spacing=1.0, cutoff=10, verbose=False):
         
+        from AutoSite.utils.clusterTPoints import DensityClustering
+        from AutoSite.scoreClusters import scoreClusters
         gc.getASPoints()
         # save list of all indices before clustering, in case clustering removes too much
         allIndices = gc._indices[:]
-        dcl = DensityClustering([spacing,spacing,spacing], neighborPts=14)
+        if self.clusteringEngine == 'autosite':
+            dcl = DensityClustering([spacing,spacing,spacing], neighborPts=14)
+        else:
+            dcl = FillPointClustering(spacing, neighborPts=14,
+                                      method=self.clusteringEngine)
         dcl.findClustersD(gc._indices,  cVolcut=cutoff)
         nbp = numpy.sum(dcl._clen)
         if nbp < 50:
@@ -523,6 +2560,7 @@ class runAGFR:
                 self.myprint( '    merging clusters ...')
             elif pocketMode =='best':
                 self.myprint( '    using best score cluster with %d points'%len(clustersorted[0][1]))
+        from AutoSite.shrink import shrinkPocket
         if pocketMode =='all':
             for cl in clustersorted:
                 if len(cl[0])<cutoff:
@@ -560,28 +2598,46 @@ class runAGFR:
         self.fillPoints = tpoints
 
     def pointsInBox(self, pts):
-        inside = []
-        outside = []
-        llx, lly, llz = self.boxCenter - self.boxLengths/2
-        urx, ury, urz = self.boxCenter + self.boxLengths/2
-        for x,y,z in pts:
-            if x>llx and x<urx and y>lly and y<ury and z>llz and z<urz:
-                inside.append( (x,y,z) )
-            else:
-                outside.append( (x,y,z) )
+        # returns lists of (x,y,z) tuples for points inside and outside the box
+        pts = numpy.asarray(pts)
+        mask = self.pointsInBoxMask(pts)
+        inside = [tuple(p) for p in pts[mask]]
+        outside = [tuple(p) for p in pts[~mask]]
         return inside, outside
 
-    def computeGrids(self, outFile, flexResStr, spacing, background=False,
-                     indent='', addGradients=False):
-        # create a folder called outfile in which we will compute the maps
-        # add TPoints and receptor and zip up as a target object
+    def pointsInBoxMask(self, pts, center=None, lengths=None):
+        # returns a boolean array that is True for points strictly inside the
+        # box. The box defaults to the current docking box
+        if center is None:
+            center = self.boxCenter
+        if lengths is None:
+            lengths = self.boxLengths
+        pts = numpy.asarray(pts, 'd').reshape(-1, 3)
+        center = numpy.asarray(center, 'd')
+        lengths = numpy.asarray(lengths, 'd')
+        ll = center - lengths/2
+        ur = center + lengths/2
+        return numpy.all((pts > ll) & (pts < ur), axis=1)
+
+    def pointsInBoxIndices(self, pts, center=None, lengths=None):
+        # returns the indices of the points inside the box
+        return numpy.nonzero(self.pointsInBoxMask(pts, center, lengths))[0]
+
+    def setDestination(self, outFile):
+        # set the destination of the target file outFile.trg and return the
+        # absolute path of the folder in which its maps are computed
         outFile = os.path.splitext(outFile)[0]
         destinationFolderPath, destinationFolder = os.path.split(outFile)
         if destinationFolderPath=='':
             destinationFolderPath = '.'
         self.destinationFolderPath = destinationFolderPath
         self.destinationFolder = destinationFolder
-        newGridsFolder = os.path.abspath(os.path.join(destinationFolderPath, destinationFolder))
+        return os.path.abspath(os.path.join(destinationFolderPath, destinationFolder))
+
+    def makeGridsFolder(self, outFile):
+        # create an empty grid folder for the target file outFile.trg
+        # Returns (folder, None) or (None, msg) on failure
+        newGridsFolder = self.setDestination(outFile)
         if os.path.exists(newGridsFolder):
             shutil.rmtree(newGridsFolder)
         try:
@@ -591,20 +2647,110 @@ class runAGFR:
             self.myprint (msg)    # the exception instance
             #print inst.filename, inst.message, inst.strerror
             return None, msg
+        return newGridsFolder, None
+
+    def computeGrids(self, outFile, flexResStr, spacing, background=False,
+                     indent='', addGradients=False):
+        # create a folder called outfile in which we will compute the maps
+        # add TPoints and receptor and zip up as a target object
+        newGridsFolder, msg = self.makeGridsFolder(outFile)
+        if newGridsFolder is None:
+            return None, msg
         # wrong to add 1 here because it was already factored in self.boxLengths in setBox
         #size = [int(ceil(x/spacing))+1 for x in self.boxLengths]
         size = self.boxSize
         # compute the grids
         t0 = time()
         #print "IN COMPUTE GRIDS", "box center", self.boxCenter, "size", size, "spacing", spacing
-        gc, status = self._computeGrids(self.boxCenter, size, spacing, self.atypes, flexResStr=flexResStr,
-                                        background=background, folder=newGridsFolder, outlev=2)
+        self.profiler.target = self.destinationFolder
+        # maps computed by AutoSite over the same grid are copied
+        asFolder, asTypes = self.reusableAutoSiteMaps(self.boxCenter, size,
+                                                      spacing, flexResStr)
+        reused = [t for t in self.atypes if t in asTypes]
+        atypes = [t for t in self.atypes if t not in reused]
+        with self.profiler.phase('map computation',
+                                 gridPoints=int(numpy.prod([n+1 for n in size])),
+                                 nbMaps=len(atypes)+2):
+            if self.mapJobs > 1 and not background:
+                gc, status = self._computeGridsByType(self.boxCenter, size, spacing, atypes,
+                                                      self.mapJobs, flexResStr=flexResStr,
+                                                      folder=newGridsFolder, outlev=2)
+            else:
+                gc, status = self._computeGrids(self.boxCenter, size, spacing, atypes, flexResStr=flexResStr,
+                                                background=background, folder=newGridsFolder, outlev=2)
+        if status==0 and len(reused):
+            mapFiles = ['rigidReceptor.%s.map'%t for t in reused]
+            for name in mapFiles:
+                shutil.copy(os.path.join(asFolder, name), newGridsFolder)
+            # list the reused maps in the grid's field file
+            fldFiles = glob(os.path.join(newGridsFolder, '*.fld'))
+            if len(fldFiles):
+                mergeFieldFiles(fldFiles[0], glob(os.path.join(asFolder, '*.fld')),
+                                mapFiles)
+            self.myprint(indent+"reused AutoSite maps %s"%' '.join(reused))
         if status==0 and not background:
             self.myprint(indent+"maps computed in %.2f (sec)"%(time()-t0))
             self.generateTrgFile(gc, newGridsFolder, flexResStr,
                                  addGradients=addGradients)
         return gc, status
 
+    def planMaps(self, secondsPerPoint=None):
+        # estimate the maps computeGrids would produce for the current box
+        # and map types without computing them. secondsPerPoint is the
+        # AutoGrid time per grid point and map (see calibrateMapTime)
+        gridPoints = int(numpy.prod([n+1 for n in self.boxSize]))
+        nbMaps = len(self.atypes)+3 # atom types, e, d and W maps
+        textBytes = nbMaps*(gridPoints*MAP_TEXT_POINT_BYTES+MAP_HEADER_BYTES)
+        pointBytes = [2, 4][self.mapEncoding=='float32'] # uint32 quantized maps are rare
+        binaryBytes = nbMaps*(gridPoints*pointBytes+128) # .npy files
+        if self.trgCompressLevel == 0:
+            trgText = textBytes
+        else:
+            trgText = int(textBytes*MAP_TEXT_DEFLATE_RATIO)
+        if self.mapFormat == 'text':
+            trgBytes = trgText
+        elif self.mapFormat == 'binary':
+            trgBytes = binaryBytes
+        else:
+            trgBytes = trgText+binaryBytes
+        plan = {'boxCenter': [float(x) for x in self.boxCenter],
+                'boxLengths': [float(x) for x in self.boxLengths],
+                'boxSize': [int(x) for x in self.boxSize],
+                'spacing': self.spacing, 'gridPoints': gridPoints,
+                'mapTypes': list(self.atypes)+['e', 'd', 'W'],
+                'mapBytes': gridPoints*4, # one float32 map in memory
+                'textMapsBytes': textBytes, 'binaryMapsBytes': binaryBytes,
+                'trgBytes': trgBytes, 'nbFillPoints': len(self.fillPoints),
+                'seconds': None}
+        if secondsPerPoint is not None:
+            plan['seconds'] = secondsPerPoint*gridPoints*(len(self.atypes)+2)
+        return plan
+
+    def reportPlan(self, plans, indent='    '):
+        MB = 1024.**2
+        for name, plan in plans:
+            self.myprint('%s%s'%(indent, name))
+            self.myprint('%s    Box center: %9.3f %9.3f %9.3f'%((indent,)+tuple(plan['boxCenter'])))
+            self.myprint('%s    Box length: %9.3f %9.3f %9.3f'%((indent,)+tuple(plan['boxLengths'])))
+            self.myprint('%s    Box size  : %9d %9d %9d (%d grid points)'%(
+                (indent,)+tuple(plan['boxSize'])+(plan['gridPoints'],)))
+            self.myprint('%s    maps      : %d %s'%(indent, len(plan['mapTypes']),
+                                                      ' '.join(plan['mapTypes'])))
+            self.myprint('%s    memory    : %.1f MB per map'%(indent, plan['mapBytes']/MB))
+            self.myprint('%s    disk      : %.1f MB text maps, %.1f MB binary maps, %.1f MB .trg file (estimated)'%(
+                indent, plan['textMapsBytes']/MB, plan['binaryMapsBytes']/MB, plan['trgBytes']/MB))
+            if plan['seconds'] is None:
+                self.myprint('%s    time      : unknown (no calibration profile)'%indent)
+            else:
+                self.myprint('%s    time      : %.1f (sec) AutoGrid (estimated)'%(indent, plan['seconds']))
+
+    def computeGridsAsync(self, scheduler, outFile, flexResStr, spacing, **kw):
+        # submit computeGrids to an AGFRJobScheduler. The future's result is
+        # (gc, status) once the maps are computed and the target file written
+        kw['background'] = False
+        return scheduler.submit(self.computeGrids, outFile, flexResStr,
+                                spacing, **kw)
+
     def generateTrgFile(self, gc, gridFolder, flexResStr, indent="", addGradients=False, logFileName=None):
         if len(gc.flexRecAtoms):
             self.myprint(indent+"the following %d flexible receptor atoms did not contribute to the grid calculation:"%len(gc.flexRecAtoms))
@@ -618,7 +2764,7 @@ class runAGFR:
                 self.myprint("")
                 self.data['flexRecFile'] = 'flexRec.pdbqt'
                 saveATOMS(self.receptor, os.path.join(gridFolder, 'flexRec.pdbqt'),
-                          gc.flexRecAtoms)
+                          gc.flexRecAtoms, self.getRecordIndex())
         else:
             self.data['flexRecFile'] = ''
         if len(gc.covalentLigAtoms):
@@ -634,7 +2780,7 @@ class runAGFR:
                 self.myprint("")
             self.data['covalentLigandFile'] = 'covalenLig.pdbqt'
             saveATOMS(self.receptor, os.path.join(gridFolder, 'covalenLig.pdbqt'),
-                      gc.covalentLigAtoms)
+                      gc.covalentLigAtoms, self.getRecordIndex())
             self.data['covalentLigandAtomIndices'] = [
                 a.getIndex() for a in gc.covalentLigAtoms]
         else:
@@ -648,6 +2794,8 @@ class runAGFR:
         self.data['mapTypes'] = mtypes
         
         if flexResStr is not None:
+            from ADFR.utils.maps import flexResStr2flexRes
+            from ADFR.utils.MakeGrids import splitFlexRes
             flexStr = flexResStr2flexRes(flexResStr)
             receptorAtoms, sideChainAtoms = splitFlexRes(self.receptor, flexStr)
         else:
@@ -656,15 +2804,30 @@ class runAGFR:
         if addGradients:
             t0 = time()
             self.myprint(indent+"Adding gradient to maps ...")
-            
-            addGradientToMaps(mapFiles, mtypes, self.data['spacing'], self.cutOffValue, errorCut=0.01, logFileName=logFileName)
+            from ADFR.utils.addGradients import addGradientToMaps
+
+            with self.profiler.phase('gradient addition'):
+                if self.gradientJobs > 1 and len(mapFiles) > 1 and _canForkPool():
+                    self.addGradientsParallel(mapFiles, mtypes, self.data['spacing'],
+                                              self.cutOffValue, errorCut=0.01,
+                                              logFileName=logFileName, indent=indent)
+                else:
+                    addGradientToMaps(mapFiles, mtypes, self.data['spacing'], self.cutOffValue, errorCut=0.01, logFileName=logFileName)
             self.myprint(indent+"done adding gradient to maps %.2f (sec)"%(time()-t0))
         self.data['mapGradients'] = addGradients
         self.data['gradCutOff'] = self.cutOffValue
         
         if "OA" in mtypes and "HD" in mtypes:
-            self.makeWmap( os.path.split(mapFiles[0])[0], self.data['spacing'], name="W", ENTROPY=self._wMapEntropy, weight=self._wMapWeight) #os.path.dirname(mapFiles[0]), self.data['spacing'])
+            with self.profiler.phase('W map'):
+                self.makeWmap( os.path.split(mapFiles[0])[0], self.data['spacing'], name="W", ENTROPY=self._wMapEntropy, weight=self._wMapWeight) #os.path.dirname(mapFiles[0]), self.data['spacing'])
             self.data['mapTypes'].append("W")
+        self.data['mapFormat'] = self.mapFormat
+        if self.mapFormat != 'text':
+            self.data['binaryMaps'] = self.writeBinaryMaps(
+                gridFolder, keepText=self.mapFormat=='both')
+            self.data['mapEncoding'] = self.mapEncoding
+            self.data['mapMaxError'] = max([0.]+[m['maxError'] for m in
+                                                 self.data['binaryMaps'].values()])
         # save translation points
         if not self.covalentBond:
             filename = os.path.join(gridFolder, 'translationPoints.npy')
@@ -687,8 +2850,11 @@ class runAGFR:
         self.data['boxSize'] = self.boxSize
         self.data['spacing'] = self.spacing
         
-        with open(os.path.join(gridFolder, 'data.pkl'), 'wb') as f:
-            pickle.dump(self.data, f)
+        with self.profiler.phase('data.pkl'):
+            if self.profiler.enabled:
+                self.data['profile'] = self.profiler.asDict()
+            with open(os.path.join(gridFolder, 'data.pkl'), 'wb') as f:
+                pickle.dump(self.data, f)
         if self.cmdOptions:
             from ADFR.utils.optParser import makeConfigFile
             cfgfile = os.path.join(gridFolder, self.destinationFolder+".cfg")
@@ -696,22 +2862,101 @@ class runAGFR:
 
         self.myprint(indent+"making target file %s ..."%(
             self.destinationFolder+'.trg',), newline=False)
-        cwd = os.getcwd()
-        # find out the path to the gridFolder:
-        gridFolderDir = os.path.abspath(os.path.dirname(gridFolder))
-        gridFolderName = os.path.basename(gridFolder)
-        # we will zip the gridFolder in the gridFolderDir (this is to avoid the error when creating the archive in the
-        # cwd on Windows that had no write permission)
-        os.chdir(gridFolderDir)
-        shutil.make_archive(self.destinationFolder, 'zip', '.',
-                            gridFolderName)
-        os.chdir(cwd)
         if not os.path.exists(self.destinationFolderPath):
            os.mkdir(self.destinationFolderPath)
-        shutil.move(os.path.join(gridFolderDir, self.destinationFolder+'.zip'),  os.path.join(self.destinationFolderPath, self.destinationFolder+'.trg'))
+        # write the archive next to its final name and rename it so that
+        # a partial .trg file is never left behind
+        trgFile = os.path.join(self.destinationFolderPath, self.destinationFolder+'.trg')
+        with self.profiler.phase('archive'):
+            # float32 maps are stored to be memory mapped, encoded maps are
+            # decoded when loaded and are compressed
+            writeZipArchive(trgFile+'.part', gridFolder, level=self.trgCompressLevel,
+                            jobs=self.trgCompressJobs,
+                            store=[(), ('.npy',)][self.mapEncoding=='float32'])
+        if os.path.exists(trgFile):
+            os.remove(trgFile)
+        os.rename(trgFile+'.part', trgFile)
         shutil.rmtree(gridFolder)
         self.myprint(indent+"done.")
         
+    def setMapEncoding(self, encoding, maxError=None):
+        # encoding of the binary maps of target files (see MAP_ENCODINGS),
+        # maxError is the maximum absolute error of quantized maps
+        assert encoding in MAP_ENCODINGS
+        self.mapEncoding = encoding
+        if maxError is not None:
+            assert maxError > 0
+            self.mapMaxError = maxError
+
+    def setGradientJobs(self, jobs):
+        # number of processes adding the gradient to the maps
+        assert jobs >= 1
+        self.gradientJobs = jobs
+
+    def addGradientsParallel(self, mapFiles, mtypes, spacing, cutOffValue,
+                             errorCut=0.01, logFileName=None, indent=''):
+        # add the gradient to every map in a pool of forked processes. Each
+        # map is logged in its own file, the logs are appended in map order
+        # to logFileName, or to the run's output when it is None, and the
+        # time of every map is reported
+        logFolder = tempfile.mkdtemp(prefix='agfrGradient')
+        jobs = [(mapFile, mtype, spacing, cutOffValue, errorCut,
+                 os.path.join(logFolder, '%s.log'%mtype))
+                for mapFile, mtype in zip(mapFiles, mtypes)]
+        sys.stdout.flush()
+        if self.summaryFP:
+            self.summaryFP.flush()
+        pool = _forkPool(min(self.gradientJobs, len(jobs)))
+        try:
+            results = pool.map(_gradientWorker, jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        try:
+            if logFileName is not None:
+                with open(logFileName, 'a') as log:
+                    for job in jobs:
+                        if os.path.exists(job[5]):
+                            with open(job[5]) as f:
+                                shutil.copyfileobj(f, log)
+            else:
+                for job in jobs:
+                    if os.path.exists(job[5]):
+                        with open(job[5]) as f:
+                            self.myprint(f.read(), newline=False)
+        finally:
+            shutil.rmtree(logFolder, ignore_errors=True)
+        failed = []
+        for mtype, dt, msg in results:
+            self.myprint(indent+"    gradient %-3s %8.2f (sec)%s"%(mtype, dt, ['', ' FAILED'][len(msg)>0]))
+            if msg:
+                failed.append(msg)
+        if len(failed):
+            raise RuntimeError('; '.join(failed))
+        return results
+
+    def writeBinaryMaps(self, gridFolder, keepText=True):
+        # save every AutoGrid map of gridFolder as a .npy file of shape
+        # (nz+1, ny+1, nx+1) encoded with self.mapEncoding. Returns
+        # {mapType: description} where description holds the .npy file
+        # name, the map header and the encoding
+        binaryMaps = {}
+        for mapFile in sorted(glob(os.path.join(gridFolder, '*.map'))):
+            header, data = loadMapFile(mapFile)
+            encoded, info = encodeMap(data, self.mapEncoding, self.mapMaxError)
+            name = os.path.splitext(os.path.basename(mapFile))[0]+'.npy'
+            numpy.save(os.path.join(gridFolder, name), encoded)
+            mtype = os.path.basename(mapFile).split('.')[-2]
+            binaryMaps[mtype] = {'file': name, 'header': header['lines'],
+                                 'spacing': header['spacing'],
+                                 'nelements': header['nelements'],
+                                 'center': header['center']}
+            binaryMaps[mtype].update(info)
+            if not keepText:
+                os.remove(mapFile)
+        return binaryMaps
+
     def setAutoSiteVersion(self, version, ligandSize=None, pepScore=None):
         self.data["AutoSiteVersion"] = version
         if ligandSize is not None:
@@ -729,50 +2974,39 @@ class runAGFR:
     def makeWmap(self, mapsFolder,  spacing, weight=0.6, ENTROPY=-0.2, name="W"):
         """ Combine OA and HD maps into W map.
         """
-        from ADFRcc.adfr import GridMap
-        OAmap = GridMap()
-        OAmap.loadFromMapFile('OA', mapsFolder, 'rigidReceptor.%s.map'%'OA')
-        OAdata = OAmap.getGridDataPy()
-
-        HDmap = GridMap()
-        HDmap.loadFromMapFile('HD', mapsFolder, 'rigidReceptor.%s.map'%'HD')
-        HDdata = HDmap.getGridDataPy()
-        wData = self.best(OAdata, HDdata, weight, ENTROPY)
-        spacing  = HDmap.getDistBetweenGridPoints()
-        from Volume.Grid3D import Grid3DF
-        grid = Grid3DF(wData.astype('f'), HDmap.getOriginPy(),
-               (spacing, spacing, spacing),
-               {'GRID_PARAMETER_FILE':'None',
-                'GRID_DATA_FILE':'None',
-                'MACROMOLECULE':'None'})
-        from Volume.IO.AutoGridWriter import WriteAutoGrid
-        writer = WriteAutoGrid()
-        writer.write(grid, os.path.join(mapsFolder, 'rigidReceptor.%s.map'%name))
+        # the combined map is streamed plane by plane from the OA and HD
+        # map files, the grid spacing is the one of the HD map
+        streamWmap(os.path.join(mapsFolder, 'rigidReceptor.OA.map'),
+                   os.path.join(mapsFolder, 'rigidReceptor.HD.map'),
+                   os.path.join(mapsFolder, 'rigidReceptor.%s.map'%name),
+                   weight, ENTROPY)
         self.data['wMapEntropy'] = ENTROPY
         self.data['wMapWeight'] = weight
         
-    def best(self, OAdata, HDdata, weight, ENTROPY):
+    def best(self, OAdata, HDdata, weight, ENTROPY, chunkSize=None, out=None):
         """
         - Return the best value between two map values
-        - If any positive values are found, 0 is returned by default
-        - by default it should be first=OA, second=HD  
+        - If any positive values are found, ENTROPY is returned
+        - by default it should be first=OA, second=HD
+        - grids larger than WMAP_CHUNK_POINTS are processed in slabs of
+          chunkSize planes along the first axis; out can be a preallocated
+          float32 array (e.g. a numpy.memmap) to keep the result out of core
         """
-        nx,ny,nz = OAdata.shape
-        wData = numpy.zeros(OAdata.shape, 'f')
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    oa = OAdata[i][j][k]
-                    hd = HDdata[i][j][k]
-                    if oa > 0 or hd > 0: 
-                        wData[i][j][k] = ENTROPY
-                    else:
-                        if oa < hd:
-                            wData[i][j][k] = OAdata[i][j][k] * weight
-                        else:
-                            wData[i][j][k] = HDdata[i][j][k] * weight
-        return wData
-        
+        shape = OAdata.shape
+        if out is None:
+            out = numpy.zeros(shape, 'f')
+        nx = shape[0]
+        planeSize = max(1, int(numpy.prod(shape[1:])))
+        if chunkSize is None:
+            if nx*planeSize <= WMAP_CHUNK_POINTS:
+                chunkSize = nx
+            else:
+                chunkSize = max(1, WMAP_CHUNK_POINTS//planeSize)
+        for i in range(0, nx, chunkSize):
+            combineWmap(OAdata[i:i+chunkSize], HDdata[i:i+chunkSize],
+                        weight, ENTROPY, out=out[i:i+chunkSize])
+        return out
+
 
     def saveCmdOptions(self, kw):
         self.cmdOptions = {}
@@ -781,6 +3015,20 @@ class runAGFR:
                self.cmdOptions[opt] = val 
    
     def __call__(self, *args, **kw):
+        # the AutoSite scratch folders are removed when the run ends. The
+        # profile is saved and the log closed also when the run fails
+        try:
+            with self.autoSiteScratch():
+                return self.run(*args, **kw)
+        finally:
+            if self.profiler.enabled and self.profiler.filename:
+                self.profiler.save(self.profiler.filename)
+                self.myprint('profile saved in %s'%self.profiler.filename)
+            if self.summaryFP:
+                self.summaryFP.close()
+                self.summaryFP = None
+
+    def run(self, *args, **kw):
 
         self.myprint( "#################################################################")
         self.myprint( "# If you used AGFR in your work, please cite:                   #")
@@ -813,6 +3061,11 @@ class runAGFR:
         # kw ['flexres', 'covalentRes', 'boxMode', 'covalentBondTorsionAtom', 'pocketMode', 'spacing', 'covalentBond', 'ligandFile', 'padding', 'mapTypes', 'smooth', 'pocketCutoff', 'receptorFile', 'outputFile']
         #print "OPTIONS", kw
         self.saveCmdOptions(kw)
+        self.profiler = PhaseProfiler(enabled=kw.get('profile', False))
+        # dry run: set the box, map types and pockets from existing fill
+        # points, report the maps that would be computed and stop
+        dryRun = kw.get('dryRun', False)
+        pockets = None # fill points of the pockets, none for covalent docking
         filename = kw.get('outputFile', None)
         if filename:
             filePath = os.path.split(filename)[0]
@@ -822,10 +3075,34 @@ class runAGFR:
             self.summaryFP = open(filenameBase+'.log', 'w')
         else:
             self.summaryFP = None
-
-        f = open(filenameBase+'_pockets.csv', "w")  ## DB0531
-        f.close()
-
+        if self.profiler.enabled:
+            self.profiler.filename = (filenameBase if filename else
+                os.path.splitext(os.path.basename(kw['receptorFile']))[0])+'_profile.json'
+
+        # pocket statistics and fill points are written in one pass by the sink
+        self.resultsSink = PocketResultsSink(filenameBase,
+            combinedFile=kw.get('pocketsTable', None),
+            receptor=os.path.basename(kw['receptorFile']))  ## DB0531
+
+        gridCache = kw.get('gridCache', None)
+        if gridCache:
+            if gridCache is True:
+                gridCache = None # default cache folder
+            self.setGridCache(gridCache, kw.get('gridCacheSize', None))
+
+        self.setTrgCompression(kw.get('trgCompressLevel', None),
+                               kw.get('trgCompressJobs', None))
+        if kw.get('mapFormat', None):
+            self.setMapFormat(kw['mapFormat'])
+        if kw.get('mapEncoding', None):
+            self.setMapEncoding(kw['mapEncoding'], kw.get('mapMaxError', None))
+
+        if kw.get('receptorCache', False):
+            self.setReceptorCache(True)
+        if kw.get('mapJobs', None):
+            self.setMapJobs(kw['mapJobs'])
+        if kw.get('gradientJobs', None):
+            self.setGradientJobs(kw['gradientJobs'])
         self.setPadding(kw['padding']) # sets self.padding
         self.setSpacing( kw['spacing']) # sets self.spacing
         self.receptorGradient = kw.get("receptorGradient", True)
@@ -835,13 +3112,15 @@ class runAGFR:
                 self.cutOffValue = -1
         # check and get the receptor
         self.myprint( 'loading receptor: %s'%kw['receptorFile'])
-        self.loadReceptor(kw['receptorFile'])  # reads receptor molecule from file and assigns Molecule instance to self.receptor 
+        with self.profiler.phase('receptor load'):
+            self.loadReceptor(kw['receptorFile'])  # reads receptor molecule from file and assigns Molecule instance to self.receptor 
 
         t0 = time()
         ligFilename = kw.get('ligandFile', None)
         if ligFilename:
             self.myprint( 'loading ligand: %s\n'%ligFilename)
-            self.loadLigand(ligFilename) # reads ligand molecule from file and assigns Molecule instance to self.ligand 
+            with self.profiler.phase('ligand load'):
+                self.loadLigand(ligFilename) # reads ligand molecule from file and assigns Molecule instance to self.ligand 
 
         # check if TPoints are provided and if so load them so that
         pocketMode = kw.get('pocketMode', None)
@@ -922,8 +3201,12 @@ class runAGFR:
                 # load TPoints from file
                 #tpoints = numpy.load(pocketMode[1])
                 pockets = [numpy.load(pocketMode[1])]
-                self.tpoints = self.pockets[0]
-                self.myprint( '    loading %d fill points from %s'%(pocketMode[1], len(tpoints)))
+                self.tpoints = pockets[0]
+                self.myprint( '    loading %d fill points from %s'%(len(self.tpoints), pocketMode[1]))
+            elif dryRun:
+                # pockets are only known after running AutoSite, dryRunPlan
+                # reports that the docking box is planned instead
+                self.myprint( '    dry run: pockets (%s) are not identified, planning maps for the docking box'%pocketMode[0])
             else:  # run AutoSite
                err = self.checkFlexResidues( flexResStr=kw['flexres'])
                if len(err):
@@ -936,8 +3219,9 @@ class runAGFR:
                    print msg
                    sys.exit(1)
 
-               gc, process = self.runAutoSite(flexResStr=kw['flexres'],
-                        smooth=kw['smooth'], background=False, verbose=True)
+               with self.profiler.phase('AutoSite fill'):
+                   gc, process = self.runAutoSite(flexResStr=kw['flexres'],
+                            smooth=kw['smooth'], background=False, verbose=True)
 
                if process!=0:
                     #self.myprint("ERROR: running autogrid failed")
@@ -949,15 +3233,19 @@ class runAGFR:
                    self.autoSite2 = True
                    self.setAutoSiteVersion("1.1", ligandSize=kw['ligandSize'], pepScore=kw['pepScore']) 
                    #run AutoSite2 for pocket detection
-                   self.clustersorted, clPropsorted, dcl = self.afterAutoSite2(gc, ligandSize=kw['ligandSize'], pepScore=kw['pepScore'], verbose=True, filenameBase=filenameBase)
+                   with self.profiler.phase('clustering'):
+                       self.clustersorted, clPropsorted, dcl = self.afterAutoSite2(gc, ligandSize=kw['ligandSize'], pepScore=kw['pepScore'], verbose=True, filenameBase=filenameBase)
                    
                else: # asversion == 1.0:
                    self.autoSite2 = False
                    self.setAutoSiteVersion("1.0") 
+                   self.setClusteringEngine(kw.get('clusteringEngine', None) or 'autosite')
                    #run original AutoSite for pockets
-                   self.clustersorted, clPropsorted, dcl = self.afterAutoSite(gc,  verbose=True)
+                   with self.profiler.phase('clustering'):
+                       self.clustersorted, clPropsorted, dcl = self.afterAutoSite(gc,  verbose=True)
                    
-               pockets = self.getFillPoints(pocketMode[0], cutoff, self.clustersorted, verbose=True)
+               with self.profiler.phase('pocket selection'):
+                   pockets = self.getFillPoints(pocketMode[0], cutoff, self.clustersorted, verbose=True)
                nfillPoints = sum(map(len, pockets))
                #import pdb;pdb.set_trace()
                ## if kw['origAutoSite'] is False:
@@ -968,16 +3256,26 @@ class runAGFR:
                ##     pockets.append([numpy.asarray(x) for x in shrinkedPoints])
                ##     nfillPoints = sum(map(len, pockets))
                self.myprint('done. got %s fill Points, in %.2f (sec)'%(nfillPoints, time()-t0))
-            if pocketMode[0]=='forEach':
+            if dryRun:
+                top = 0 # a dry run plans one target, see dryRunPlan
+            elif pocketMode[0]=='forEach':
                 top = len(self.clustersorted)
             elif pocketMode[0]=='forTop':
                 top = cutoff
             else:
                 top = 0
+            if top != 0:
+                for n, fp in enumerate(pockets):
+                    self.resultsSink.addPocketPoints(n, fp)
+        if not dryRun: # a dry run only writes its plan
+            self.resultsSink.flush()
                 
         # find out which types are needed
         mapTypes = self.setMapTypes(kw['mapTypes'])
         self.myprint( '\nsetting map types using: %s to %s'%(mapTypes, self.atypes))
+        if dryRun:
+            return self.dryRunPlan(kw, filenameBase, boxMode, pockets, covalentBond,
+                                   pocketMode)
         t0 = time()
         if top == 0: # we will have a single output file
             size = self.boxSize
@@ -1013,15 +3311,19 @@ class runAGFR:
                 self.myprint( '\ncreating maps for %d top rancking pockets ...'%top)
 
 
+            jobs = kw.get('jobs', None) or 1
+            superset = kw.get('supersetGrid', False)
+            if jobs > 1 and not _canForkPool():
+                self.myprint('    WARNING: --jobs requires fork() and a non daemonic process, computing pockets serially')
+                jobs = 1
+            results = []
+            pocketJobs = []
             for n, fp in enumerate(pockets):
                 self.setBoxForCoords(fp, kw['padding'], kw['spacing'])  ##### added by David Bajusz 05/23
-                self.fillPoints, outside = self.pointsInBox(fp)
-
-                f = open(filenameBase+'_pocket%03d.csv'%n,'w')  ##### added by David Bajusz 05/31
-                f.write('x,y,z\n')
-                for point in fp:
-                    f.write('%f,%f,%f\n' % (point[0],point[1],point[2]) )
-                f.close()
+                # only the pocket's own points are tested against its box
+                pocketPoints = numpy.reshape(fp, (-1, 3))
+                self.fillPoints = [tuple(p) for p in pocketPoints[
+                    self.pointsInBoxMask(pocketPoints, self.boxCenter, self.boxLengths)]]
 
                 #if pocketMode[0] =='forEach' and len(self.fillPoints)< cutoff:
                 #    continue
@@ -1038,31 +3340,367 @@ class runAGFR:
                     size[0], size[1], size[2]))
                 
                 self.myprint('    %d points inside the box\n'%len(self.fillPoints))  
+                if jobs > 1 or superset:
+                    pocketJobs.append((n, filename, self.boxCenter, self.boxSize,
+                                       self.boxLengths, self.fillPoints))
+                    continue
+                t1 = time()
                 gc, status = self.computeGrids(
                     filename, kw['flexres'], kw['spacing'],
                     indent="    ")
-
-            if status !=0:
+                results.append((n, filename, status, time()-t1,
+                                self.gridsStatusMessage(gc, status)))
+
+            if superset:
+                results = self.computeSupersetPocketGrids(
+                    pocketJobs, kw['flexres'], kw['spacing'])
+            elif len(pocketJobs):
+                results = self.computePocketGridsParallel(
+                    pocketJobs, kw['flexres'], kw['spacing'], jobs)
+            failed = self.reportPocketGrids(results)
+            if len(failed):
                 #self.myprint('ERROR: AutoGrid failed to run in %s'%gc.folder)
-                raise RuntimeError('ERROR: AutoGrid failed to run in %s'%gc.folder)
+                raise RuntimeError('ERROR: %s'%'; '.join([r[4] for r in failed]))
         self.myprint('    done. %.2f (sec)\n'%(time()-t0))
+
+    def dryRunPlan(self, kw, filenameBase, boxMode, pockets, covalentBond,
+                   pocketMode=None):
+        # plan the target file of __call__ for the box and fill points that
+        # are set. The plans are saved in <filenameBase>_plan.json and returned.
+        # Pockets AutoSite would identify are unknown: a single target for the
+        # docking box is planned and the plan says so
+        profiles = kw.get('calibrationProfiles', None) or []
+        if isinstance(profiles, str):
+            profiles = glob(profiles)
+        secondsPerPoint, nbSamples = calibrateMapTime(profiles)
+        if covalentBond is None and pockets is not None:
+            self.fillPoints, outside = self.pointsInBox(pockets[0])
+            if boxMode[0]=='fill':
+                self.setBoxForCoords(self.fillPoints, kw['padding'], kw['spacing'])
+        elif boxMode[0]=='fill':
+            self.myprint( '    dry run: no fill points, planning the receptor box')
+            self.setBox(['receptor'], self.padding, kw['spacing'])
+        plans = [(os.path.basename(filenameBase)+'.trg',
+                  self.planMaps(secondsPerPoint))]
+        requested = (pocketMode or [None])[0]
+        planned = requested
+        if covalentBond is None and pockets is None:
+            planned = 'box'
+        self.myprint('\ndry run, maps that would be computed:')
+        if planned != requested:
+            self.myprint('    pocket mode %s planned as a single target for the docking box'%requested)
+        if secondsPerPoint is not None:
+            self.myprint('    time calibrated from %d map computation(s), %.3g (sec) per grid point and map'%(
+                nbSamples, secondsPerPoint))
+        self.reportPlan(plans)
+        total = sum([plan['trgBytes'] for name, plan in plans])
+        self.myprint('    total .trg size %.1f MB'%(total/1024.**2))
+        with open(filenameBase+'_plan.json', 'w') as f:
+            json.dump({'secondsPerPoint': secondsPerPoint,
+                       'calibrationSamples': nbSamples,
+                       'pocketMode': requested, 'plannedPocketMode': planned,
+                       'targets': [dict(plan, target=name) for name, plan in plans]},
+                      f, indent=1)
+        self.myprint('plan saved in %s_plan.json'%filenameBase)
+        return plans
+
+    def ensembleBox(self, molecules, boxMode, padding, spacing):
+        # set the box encompassing the boxes of boxMode computed for every
+        # receptor of an ensemble. Returns the box center, size and lengths
+        lower = []
+        upper = []
+        for mol in molecules:
+            self.setReceptor(mol)
+            self.setBox(list(boxMode), padding, spacing)
+            lower.append(self.boxCenter-self.boxLengths/2.)
+            upper.append(self.boxCenter+self.boxLengths/2.)
+        # the box lengths are multiples of spacing, keep rounding errors
+        # from adding grid points
+        corners = numpy.array([numpy.min(lower, 0)+1e-6, numpy.max(upper, 0)-1e-6])
+        self.setBoxForCoords(corners, 0., spacing)
+        self.padding = padding
+        self.data['boxPadding'] = padding
+        return self.boxCenter, self.boxSize, self.boxLengths
+
+    def ensemblePocket(self, mol, flexResStr, smooth, pocketMode, pocketCutoff):
+        # run AutoSite in the current box and return the fill points of
+        # pocketMode for the receptor mol
+        gc, status = self.runAutoSite(flexResStr=flexResStr,
+                                      smooth=smooth, verbose=True)
+        if status != 0:
+            raise RuntimeError("ERROR: running autogrid failed for %s"%mol.filename)
+        self.clustersorted, clProp, dcl = self.afterAutoSite(gc, verbose=True)
+        return self.getFillPoints(pocketMode, pocketCutoff, self.clustersorted)[0]
+
+    def prepareEnsemble(self, receptorFiles, outputBase, boxMode=None,
+                        ligandFile=None, padding=4.0, spacing=0.375,
+                        mapTypes='all', flexResStr=None, fillPoints=None,
+                        pocketMode='all', pocketCutoff=10, smooth=0.5,
+                        addGradients=True):
+        # write the target files of an ensemble of receptor conformations
+        # on one grid: the box encompasses the boxes of boxMode of all the
+        # receptors, so that all maps share center, size and spacing and
+        # can be combined point by point. The ligand, map types and force
+        # field parameters are read once. fillPoints (array or .npy file
+        # name) are used for all the receptors, else AutoSite identifies
+        # the pockets of every receptor in the common box. With box mode
+        # 'fill' and no fill points, AutoSite runs in the box of each
+        # receptor and the box encompasses the union of the pockets.
+        # Targets are written to <outputBase>_<index>_<receptor>.trg and
+        # described in <outputBase>_ensemble.json. Returns the list of
+        # target files
+        if len(self.covalentBondToExclude):
+            raise ValueError('ensembles of covalent receptors are not supported')
+        if addGradients and self.cutOffValue is None:
+            self.cutOffValue = -1 # same default as __call__
+        if ligandFile:
+            self.loadLigand(ligandFile)
+        if boxMode is None:
+            boxMode = [['receptor'], ['ligand']][ligandFile is not None]
+        molecules = []
+        for filename in receptorFiles:
+            self.myprint('loading receptor: %s'%filename)
+            self.loadReceptor(filename)
+            molecules.append(self.receptor)
+        if isinstance(fillPoints, str):
+            fillPoints = numpy.load(fillPoints)
+        self.data['flexResStr'] = flexResStr
+        mapTypes = self.setMapTypes(mapTypes)
+        self.myprint('setting map types using: %s to %s'%(mapTypes, self.atypes))
+        with self.autoSiteScratch():
+            return self._prepareEnsemble(molecules, outputBase, boxMode,
+                                         padding, spacing, flexResStr,
+                                         fillPoints, pocketMode, pocketCutoff,
+                                         smooth, addGradients)
+
+    def _prepareEnsemble(self, molecules, outputBase, boxMode, padding,
+                         spacing, flexResStr, fillPoints, pocketMode,
+                         pocketCutoff, smooth, addGradients):
+        pockets = {} # receptor index: fill points found by AutoSite
+        if boxMode[0] == 'fill' and fillPoints is None:
+            for n, mol in enumerate(molecules):
+                self.setReceptor(mol)
+                self.setBox(['receptor'], padding, 1.0)
+                self.myprint('\nidentifying pockets of %s ...'%os.path.basename(mol.filename))
+                pockets[n] = self.ensemblePocket(mol, flexResStr, smooth,
+                                                 pocketMode, pocketCutoff)
+            allPoints = numpy.concatenate([numpy.reshape(pockets[n], (-1, 3))
+                                           for n in range(len(molecules))])
+            if len(allPoints) == 0:
+                raise RuntimeError("AutoSite found no pockets in the ensemble")
+            self.myprint('set box using fill with %d points from %d receptors'%(
+                len(allPoints), len(molecules)))
+            self.setBoxForCoords(allPoints, padding, spacing)
+        elif boxMode[0] == 'fill':
+            self.setBoxForCoords(fillPoints, padding, spacing)
+        else:
+            self.ensembleBox(molecules, boxMode, padding, spacing)
+        center, size, lengths = self.boxCenter, self.boxSize, self.boxLengths
+        origin = center-numpy.array(size)*spacing/2.
+        self.myprint('ensemble of %d receptors'%len(molecules))
+        self.myprint('    Box center: %9.3f %9.3f %9.3f'%tuple(center))
+        self.myprint('    Box length: %9.3f %9.3f %9.3f'%tuple(lengths))
+        self.myprint('    Box size  : %9d %9d %9d'%tuple(size))
+        self.myprint('    origin    : %9.3f %9.3f %9.3f'%tuple(origin))
+        targets = []
+        for n, mol in enumerate(molecules):
+            self.setReceptor(mol)
+            self.boxCenter, self.boxSize, self.boxLengths = center, size, lengths
+            self.data['boxCenter'] = center
+            self.data['boxSize'] = size
+            self.data['boxLengths'] = lengths
+            if n in pockets:
+                points = pockets[n]
+            elif fillPoints is None:
+                points = self.ensemblePocket(mol, flexResStr, smooth,
+                                             pocketMode, pocketCutoff)
+            else:
+                points = fillPoints
+            self.fillPoints, outside = self.pointsInBox(points)
+            if len(self.fillPoints) == 0:
+                raise RuntimeError("no fill points found inside the docking box for %s"%mol.filename)
+            self.data['ensemble'] = {'receptors': [os.path.basename(m.filename) for m in molecules],
+                                     'index': n, 'origin': [float(x) for x in origin]}
+            # snapshots often share a file name, the index keeps them apart
+            name = '%s_%03d_%s'%(outputBase, n, os.path.splitext(os.path.basename(mol.filename))[0])
+            self.myprint('\ncomputing maps for %s ...'%os.path.basename(mol.filename))
+            gc, status = self.computeGrids(name, flexResStr, spacing,
+                                           indent='    ', addGradients=addGradients)
+            if status != 0:
+                raise RuntimeError('ERROR: %s'%self.gridsStatusMessage(gc, status))
+            targets.append(name+'.trg')
+        with open(outputBase+'_ensemble.json', 'w') as f:
+            json.dump({'receptors': [os.path.abspath(m.filename) for m in molecules],
+                       'targets': targets, 'mapTypes': list(self.atypes),
+                       'boxCenter': [float(x) for x in center],
+                       'boxLengths': [float(x) for x in lengths],
+                       'boxSize': [int(x) for x in size], 'spacing': spacing,
+                       'origin': [float(x) for x in origin]}, f, indent=1)
+        return targets
+
+    def snapBoxToLattice(self, center, size, origin, spacing):
+        # grow the box (center, size) outward to the nearest points of the
+        # lattice with the given origin and spacing. Returns the index of
+        # the box origin on the lattice, the new size (even) and center
+        center = numpy.asarray(center, 'd')
+        half = numpy.array(size, 'd')*spacing/2
+        start = numpy.floor((center-half-origin)/spacing+1e-6).astype('int')
+        end = numpy.ceil((center+half-origin)/spacing-1e-6).astype('int')
+        newSize = end-start
+        newSize += newSize%2 # keep an even number of intervals
+        newCenter = origin + (start + newSize/2)*spacing
+        return start, [int(x) for x in newSize], newCenter
+
+    def computeSupersetPocketGrids(self, pocketJobs, flexResStr, spacing,
+                                   indent="    "):
+        # compute the maps once on the union of the pocket boxes and cut
+        # each pocket's maps out of that grid. Pocket boxes are grown to
+        # the nearest points of the shared lattice so that slices are exact.
+        # pocketJobs is a list of
+        # (n, filename, boxCenter, boxSize, boxLengths, fillPoints).
+        # Returns a list of (n, filename, status, seconds, message)
+        lo = numpy.min([numpy.asarray(c)-numpy.asarray(l)/2
+                        for n, fn, c, s, l, fp in pocketJobs], 0)
+        hi = numpy.max([numpy.asarray(c)+numpy.asarray(l)/2
+                        for n, fn, c, s, l, fp in pocketJobs], 0)
+        # 2 extra intervals leave room for snapping the pocket boxes outward
+        supSize = [int(ceil(x/spacing-1e-6))+2 for x in hi-lo]
+        supSize = [x+x%2 for x in supSize]
+        supCenter = lo + numpy.array(supSize, 'd')*spacing/2
+        self.myprint(indent+'computing superset maps for center=(%.3f %.3f %.3f) dims=(%d %d %d) ...'%(
+            tuple(supCenter)+tuple(supSize)))
+        supFolder = tempfile.mkdtemp(prefix='agfrSuperset',
+            dir=os.path.dirname(os.path.abspath(pocketJobs[0][1])))
+        try:
+            t0 = time()
+            self.profiler.target = 'superset'
+            with self.profiler.phase('map computation',
+                                     gridPoints=int(numpy.prod([n+1 for n in supSize])),
+                                     nbMaps=len(self.atypes)+2):
+                gc, status = self._computeGridsByType(supCenter, supSize, spacing,
+                                                      self.atypes, self.mapJobs,
+                                                      flexResStr=flexResStr,
+                                                      folder=supFolder, outlev=2)
+            if status != 0:
+                msg = self.gridsStatusMessage(gc, status)
+                return [(job[0], job[1], status, time()-t0, msg)
+                        for job in pocketJobs]
+            self.myprint(indent+"maps computed in %.2f (sec)"%(time()-t0))
+            t0 = time()
+            # snap every pocket box and create its grid folder with the
+            # non-map files of the superset folder
+            pockets = []
+            for n, filename, center, size, lengths, fillPoints in pocketJobs:
+                start, size, center = self.snapBoxToLattice(
+                    center, size, lo, spacing)
+                folder, msg = self.makeGridsFolder(filename)
+                if folder is None:
+                    return [(job[0], job[1], -1, 0., msg) for job in pocketJobs]
+                for name in os.listdir(supFolder):
+                    if not name.endswith('.map'):
+                        shutil.copy(os.path.join(supFolder, name), folder)
+                rewriteGridDescriptors(folder, size, center, spacing)
+                pockets.append((n, filename, folder, start, size, center, fillPoints))
+            # slice every map for all pockets, one map in memory at a time
+            for mapFile in glob(os.path.join(supFolder, '*.map')):
+                header, data = loadMapFile(mapFile)
+                name = os.path.basename(mapFile)
+                for n, filename, folder, start, size, center, fp in pockets:
+                    i, j, k = start
+                    nx, ny, nz = size
+                    writeMapFile(os.path.join(folder, name),
+                                 mapHeader(header, size, center),
+                                 data[k:k+nz+1, j:j+ny+1, i:i+nx+1])
+            self.myprint(indent+"%d pocket maps sliced in %.2f (sec)"%(
+                len(pockets), time()-t0))
+            results = []
+            for n, filename, folder, start, size, center, fillPoints in pockets:
+                t0 = time()
+                self.boxCenter = center
+                self.boxSize = size
+                self.boxLengths = numpy.array(size, 'd')*spacing
+                self.fillPoints = fillPoints
+                self.setDestination(filename)
+                self.profiler.target = self.destinationFolder
+                try:
+                    self.generateTrgFile(gc, folder, flexResStr, indent=indent)
+                    status, msg = 0, ''
+                except Exception as e:
+                    status, msg = -1, 'pocket %d: %s'%(n, e)
+                results.append((n, filename, status, time()-t0, msg))
+            return results
+        finally:
+            shutil.rmtree(supFolder, ignore_errors=True)
+
+    def gridsStatusMessage(self, gc, status):
+        # message describing the outcome of computeGrids
+        if gc is None: # the grid folder could not be created
+            return status
+        if status != 0:
+            return 'AutoGrid failed to run in %s'%gc.folder
+        return ''
+
+    def computePocketGridsParallel(self, pocketJobs, flexResStr, spacing, jobs):
+        # compute the grids and target files of several pockets concurrently
+        # in forked worker processes. pocketJobs is a list of
+        # (n, filename, boxCenter, boxSize, boxLengths, fillPoints).
+        # Each worker writes its output to filename.log and its maps in
+        # its own grid folder. Returns a list of
+        # (n, filename, status, seconds, message) sorted by pocket number
+        self.myprint('    computing %d pockets using %d processes ...'%(
+            len(pocketJobs), jobs))
+        # flush buffered output so that forked workers do not write it again
+        sys.stdout.flush()
         if self.summaryFP:
-            self.summaryFP.close()
+            self.summaryFP.flush()
+        pool = _forkPool(min(jobs, len(pocketJobs)), agfr=self)
+        try:
+            results = []
+            args = [job+(flexResStr, spacing) for job in pocketJobs]
+            for result, phases in pool.imap_unordered(_pocketGridsWorker, args):
+                self.profiler.phases.extend(phases)
+                n, filename, status, dt, msg = result
+                self.myprint('    pocket %d done in %.2f (sec)%s'%(
+                    n, dt, ['', ' FAILED'][status!=0]))
+                results.append(result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        results.sort()
+        return results
+
+    def reportPocketGrids(self, results):
+        # print the status of every pocket and return the failed ones
+        failed = []
+        self.myprint('\n    pocket| status |   time  | target')
+        self.myprint('    ------+--------+---------+-------------------')
+        for n, filename, status, dt, msg in results:
+            if status == 0:
+                self.myprint('     %4d    ok    %8.2f  %s.trg'%(n, dt, os.path.basename(filename)))
+            else:
+                failed.append((n, filename, status, dt, msg))
+                self.myprint('     %4d  FAILED  %8.2f  %s'%(n, dt, msg))
+        return failed
 
     def checkFlexResidues(self, flexResStr):
         # Check if the moving atoms of flex residues are inside the box
+        from ADFR.utils.maps import flexResStr2flexRes
         flexresList =  flexResStr2flexRes(flexResStr)
         outsideRes = {}
         err = []
+        resIndex = self.getResidueIndex()
+        coords = self.receptor._ag.getCoords()
+        backbone = ('CA', 'N', 'C', 'O')
         #import pdb; pdb.set_trace()
         for frchain in flexresList:
             ch = frchain[0]
             for fr in frchain[1]:
-                _flres = [[ch, [fr]]]
-                flexresAtoms = splitFlexRes(self.receptor, _flres, exclude='CA N C O')[1]
-                inside, outside = self.pointsInBox(flexresAtoms.getCoords())
-                if len(outside):
-                    if not outsideRes.has_key(ch):
+                atoms = resIndex.get((ch.strip(), fr[0], fr[1]), {})
+                indices = [i for name, ind in atoms.items() if name not in backbone
+                           for i in ind]
+                if not numpy.all(self.pointsInBoxMask(coords[indices])):
+                    if ch not in outsideRes:
                         outsideRes[ch] = ""
                     else:
                         outsideRes[ch]+=", "
@@ -1085,14 +3723,10 @@ class runAGFR:
                     if not len(errmsg):errmsg = errorCodes[110]
                     err.append((110, [errmsg, (chid, resname, resnum)]))
                     return err
+                atoms = resIndex.get((chid.strip(), resname, resnum), {})
                 for i, adef in enumerate(angleDef):
-                    if chid == ' ':
-                        tatoms = self.receptor.select('chid "%s" resname %s resnum %s name %s %s %s %s'%(
-                            (chid, resname, resnum)+tuple(adef[0])))
-                    else:
-                        tatoms = self.receptor.select('chid %s resname %s resnum %s name %s %s %s %s'%(
-                            (chid, resname, resnum)+tuple(adef[0])))
-                    if len(tatoms)<4:
+                    found = [name for name in adef[0] if name in atoms]
+                    if len(found)<4:
                         err.append((108, "Chi angle defining atoms (%s: %s%s) not found in receptor" %(chid, resname, resnum)))
         return err
 
@@ -1105,8 +3739,7 @@ class runAGFR:
         else:
             # check that the covalent bond atoms are in Box
             coords = numpy.array(self.data['covalentAtomsCoords']).reshape(3,3)
-            inside, outside = self.pointsInBox(coords)
-            if len(outside):
+            if not numpy.all(self.pointsInBoxMask(coords)):
                 #print "ERROR: %s" % errorCodes[104]
                 err.append((104, errorCodes[104]))
         return err
@@ -1131,8 +3764,7 @@ class runAGFR:
         else:
             # Check that at least some atoms of the receptor are in the box:
             coords = self.receptor._ag.getCoords()
-            inside, outside = self.pointsInBox(coords)
-            if not len(inside):
+            if not numpy.any(self.pointsInBoxMask(coords)):
                 #print "ERROR: %s" % errorCodes[102]
                 err.append((102, errorCodes[102]))
 
@@ -1152,8 +3784,7 @@ class runAGFR:
                 #print "ERROR: %s" % errorCodes[105]
                 err.append((105, errorCodes[105]))
             else:
-                inside, outside = self.pointsInBox(self.fillPoints)
-                if not len(inside):
+                if not numpy.any(self.pointsInBoxMask(self.fillPoints)):
                     #print """ERROR: %s""" % errorCodes[106]
                     err.append((106, errorCodes[106]))
         if not len(self.atypes):
@@ -1164,3 +3795,217 @@ class runAGFR:
         else:
             return [(0, "Ready to compute maps")]
 
+##
+## validation without the docking engine
+##
+# validateBox checks receptor/box combinations using only numpy: the PDBQT
+# coordinates are parsed directly and MolKit2, prody, ADFR and AutoSite are
+# not imported.
+
+def parseFlexResStr(flexResStr):
+    # "A:ILE10,GLU34;B:THR5" -> [('A', [('ILE', 10), ('GLU', 34)]), ('B', [('THR', 5)])]
+    flexRes = []
+    if not flexResStr:
+        return flexRes
+    for chainStr in flexResStr.split(';'):
+        if not chainStr.strip():
+            continue
+        if ':' in chainStr:
+            chid, resStr = chainStr.split(':', 1)
+        else:
+            chid, resStr = '', chainStr
+        residues = []
+        for res in resStr.split(','):
+            res = res.strip()
+            i = len(res)
+            while i > 0 and (res[i-1].isdigit() or res[i-1] == '-'):
+                i -= 1
+            if i == 0 or i == len(res):
+                raise ValueError('bad flexible residue %s in %s'%(res, flexResStr))
+            residues.append((res[:i], int(res[i:])))
+        flexRes.append((chid.strip(), residues))
+    return flexRes
+
+def readPDBQTAtoms(filename):
+    # return (coords, names, resnames, chids, resnums, hasTorsionTree) for
+    # the ATOM and HETATM records of a PDB/PDBQT file
+    records = []
+    hasTorsionTree = False
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                records.append(line)
+            elif line.startswith('ROOT'):
+                hasTorsionTree = True
+    coords = numpy.array([(l[30:38], l[38:46], l[46:54]) for l in records],
+                         'd').reshape(-1, 3)
+    names = numpy.array([l[12:16].strip() for l in records])
+    resnames = numpy.array([l[17:20].strip() for l in records])
+    chids = numpy.array([l[21:22].strip() for l in records])
+    resnums = numpy.array([int(l[22:26]) for l in records], 'i')
+    return coords, names, resnames, chids, resnums, hasTorsionTree
+
+def validateBox(receptorFile, boxMode=None, padding=4.0, spacing=0.375,
+                ligandFile=None, flexResStr=None, fillPoints=None):
+    # compute the docking box, grid dimensions and in-box checks of
+    # checkComputeGrids for a receptor file without loading the docking
+    # engine. boxMode is a setBox mode list. Returns a dict with boxCenter,
+    # boxSize, boxLengths, nbGridPoints and errors (list of (code, msg))
+    agfr = runAGFR()
+    err = []
+    coords, names, resnames, chids, resnums, tree = readPDBQTAtoms(receptorFile)
+    if tree:
+        err.append((111, "the file %s contains a torsion tree indicating this is a ligand."%receptorFile))
+    flexRes = parseFlexResStr(flexResStr)
+    sideChain = numpy.zeros(len(coords), bool)
+    notBackbone = ~numpy.in1d(names, ('CA', 'N', 'C', 'O'))
+    for chid, residues in flexRes:
+        for resname, resnum in residues:
+            sideChain |= ((chids == chid) & (resnames == resname) &
+                          (resnums == resnum) & notBackbone)
+    if boxMode is None:
+        boxMode = ['ligand'] if ligandFile else ['receptor']
+    mode = list(boxMode)
+    lengths = None
+    if mode[0] == 'user' and mode[1] in ['receptor', 'ligand', 'fill', 'residues']:
+        lengths = numpy.array([float(x) for x in mode[2:5]])
+        mode[0] = mode[1]
+    if mode[0] == 'receptor':
+        boxCoords = coords
+    elif mode[0] == 'ligand':
+        boxCoords, ligTree = readPDBQTAtoms(ligandFile)[0::5]
+        if not ligTree:
+            err.append((112, "the file %s does not contain a torsion tree indicating this is a receptor."%ligandFile))
+    elif mode[0] == 'fill':
+        boxCoords = numpy.asarray(fillPoints, 'd')
+    elif mode[0] == 'residues':
+        boxCoords = coords[sideChain]
+    elif mode[0] == 'user':
+        center = numpy.array([float(x) for x in mode[1:4]])
+        lengths = numpy.array([float(x) for x in mode[4:7]])
+        boxCoords = None
+    else:
+        raise ValueError("validateBox: ERROR bad mode expected receptor, ligand, fill, residues, or user, got %s"%boxMode)
+    if lengths is None:
+        center, size, lengths = agfr.boxForCoords(boxCoords, padding, spacing)
+    else:
+        if boxCoords is not None:
+            center = 0.5*(numpy.min(boxCoords, 0)+numpy.max(boxCoords, 0))
+        size = agfr.boxForCoords(numpy.array([-lengths/2, lengths/2]), 0., spacing)[1]
+    inBox = agfr.pointsInBoxMask(coords, center, lengths)
+    if not numpy.any(inBox):
+        err.append((102, errorCodes[102]))
+    # same message as checkFlexResidues: residues grouped by chain
+    outsideRes = {}
+    for chid, residues in flexRes:
+        for resname, resnum in residues:
+            res = sideChain & (chids == chid) & (resnames == resname) & (resnums == resnum)
+            if not numpy.any(res):
+                err.append((113, [errorCodes[113], (chid, resname, resnum)]))
+            elif not numpy.all(inBox[res]):
+                if chid not in outsideRes:
+                    outsideRes[chid] = ""
+                else:
+                    outsideRes[chid] += ", "
+                outsideRes[chid] += "%s%d"%(resname, resnum)
+    if len(outsideRes):
+        outsideResStr = ""
+        for k, v in sorted(outsideRes.items()):
+            outsideResStr += "%s: %s " %(k, v)
+        err.append((103, "Flexible residue(s) %s outside the box." % outsideResStr))
+    if fillPoints is not None and mode[0] != 'fill':
+        if not numpy.any(agfr.pointsInBoxMask(fillPoints, center, lengths)):
+            err.append((106, errorCodes[106]))
+    return {'boxCenter': center, 'boxSize': size, 'boxLengths': lengths,
+            'nbGridPoints': int(numpy.prod([n+1 for n in size])),
+            'receptorAtomsInBox': int(numpy.sum(inBox)), 'errors': err}
+
+def benchmarkColdStart(receptorFile=None, repeat=3):
+    # time fresh interpreters importing this module, validating a receptor
+    # with validateBox and importing the docking engine (warmUp)
+    import subprocess
+    folder = os.path.dirname(os.path.abspath(__file__))
+    tests = [('import', 'import runAGFR')]
+    if receptorFile is not None:
+        tests.append(('validateBox', 'import runAGFR; runAGFR.validateBox(%r)'%
+                      os.path.abspath(receptorFile)))
+    tests.append(('warmUp', 'import runAGFR; runAGFR.warmUp()'))
+    results = {}
+    for name, code in tests:
+        times = []
+        for n in range(repeat):
+            t0 = time()
+            status = subprocess.call([sys.executable, '-c', code], cwd=folder)
+            times.append(time()-t0)
+            if status != 0:
+                break
+        results[name] = (status, min(times))
+        if status != 0:
+            print('%12s   failed (exit status %d)'%(name, status))
+        else:
+            print('%12s %8.3f (sec)'%(name, min(times)))
+    return results
+
+if __name__ == '__main__':
+    # maintenance commands:
+    #   python runAGFR.py benchWmap [size ...]
+    #   python runAGFR.py gridCacheStats [cacheFolder]
+    #   python runAGFR.py serve queueFolder [jobs]
+    #   python runAGFR.py benchClustering [fillPointIndices.npy]
+    #   python runAGFR.py validate receptor.pdbqt [cx cy cz sx sy sz]
+    #   python runAGFR.py coldStart [receptor.pdbqt]
+    #   python runAGFR.py ensemble outputBase [-l ligand.pdbqt] [-p padding] [-s spacing] [-t mapTypes] [-f flexres] receptor.pdbqt ...
+    #   python runAGFR.py trgInfo target.trg
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchWmap':
+        sizes = [int(x) for x in sys.argv[2:]] or (16, 32, 64, 96)
+        benchmarkWmap(sizes)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'gridCacheStats':
+        printGridCacheStats((sys.argv[2:] or [None])[0])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'benchClustering':
+        benchmarkClustering(numpy.load(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'validate':
+        mode = None
+        if len(sys.argv) == 9:
+            mode = ['user']+sys.argv[3:9]
+        result = validateBox(sys.argv[2], mode)
+        print('box center %.3f %.3f %.3f'%tuple(result['boxCenter']))
+        print('box lengths %.3f %.3f %.3f'%tuple(result['boxLengths']))
+        print('grid size %d %d %d (%d points)'%(tuple(result['boxSize'])+(result['nbGridPoints'],)))
+        for code, msg in result['errors']:
+            print('ERROR %d: %s'%(code, msg))
+        sys.exit(len(result['errors']) > 0)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'coldStart':
+        benchmarkColdStart((sys.argv[2:] or [None])[0])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'trgInfo':
+        with TargetFile(sys.argv[2]) as trg:
+            data = trg.data()
+            for k in sorted(data.keys()):
+                if k not in ('binaryMaps', 'profile'):
+                    print('%-24s %s'%(k, data[k]))
+            for mtype in trg.mapTypes():
+                header = trg.mapHeader(mtype)
+                print('map %-4s nelements %s spacing %s'%(
+                    mtype, header['nelements'], header['spacing']))
+    elif len(sys.argv) > 3 and sys.argv[1] == 'ensemble':
+        import getopt
+        opts, args = getopt.getopt(sys.argv[3:], 'l:p:s:t:f:')
+        opts = dict(opts)
+        mapTypes = opts.get('-t', 'all')
+        if mapTypes not in ('all', 'ligand') and not mapTypes.startswith('library:'):
+            mapTypes = mapTypes.replace(',', ' ').split()
+        runAGFR().prepareEnsemble(args, sys.argv[2], ligandFile=opts.get('-l'),
+                                  padding=float(opts.get('-p', 4.0)),
+                                  spacing=float(opts.get('-s', 0.375)),
+                                  mapTypes=mapTypes, flexResStr=opts.get('-f'))
+    elif len(sys.argv) > 2 and sys.argv[1] == 'serve':
+        serveAGFR(sys.argv[2], jobs=int((sys.argv[3:] or [2])[0]))
+    else:
+        print('usage: python runAGFR.py benchWmap [size ...]')
+        print('       python runAGFR.py gridCacheStats [cacheFolder]')
+        print('       python runAGFR.py serve queueFolder [jobs]')
+        print('       python runAGFR.py benchClustering [fillPointIndices.npy]')
+        print('       python runAGFR.py validate receptor.pdbqt [cx cy cz sx sy sz]')
+        print('       python runAGFR.py coldStart [receptor.pdbqt]')
+        print('       python runAGFR.py ensemble outputBase [-l ligand.pdbqt] [-p padding] [-s spacing] [-t mapTypes] [-f flexres] receptor.pdbqt ...')
+        print('       python runAGFR.py trgInfo target.trg')
+        sys.exit(1)